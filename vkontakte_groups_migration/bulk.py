@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from itertools import islice, izip
+
+from django.conf import settings
+from django.db import connection
+
+from .db import drop_table, is_postgresql, quote_name
+from .ids import sorted_unique
+
+BULK_CHUNK_SIZE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_BULK_CHUNK_SIZE', 10000)
+
+
+def chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def format_value(value):
+    '''
+    Format value for text format of COPY
+    '''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_rows(rows, chunk_size):
+    for chunk in chunks(rows, chunk_size):
+        yield ''.join(['\t'.join([format_value(value) for value in row]) + '\n' for row in chunk])
+
+
+class IterFile(object):
+    '''
+    Read-only file-like object over iterator of strings, data is generated while reading
+    '''
+
+    def __init__(self, iterable):
+        self.iterable = iter(iterable)
+        self.data = ''
+        self.position = 0
+
+    def read(self, size=-1):
+        result = []
+        while size < 0 or size > 0:
+            if self.position >= len(self.data):
+                self.data = next(self.iterable, None)
+                self.position = 0
+                if self.data is None:
+                    self.data = ''
+                    break
+                continue
+            end = len(self.data) if size < 0 else self.position + size
+            chunk = self.data[self.position:end]
+            self.position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+            result.append(chunk)
+        return ''.join(result)
+
+
+def copy_rows(cursor, table, columns, rows, chunk_size=None):
+    '''
+    Stream rows to the table by COPY ... FROM STDIN. Rows are formatted by chunks,
+    so memory is used only for one chunk of rows
+    '''
+    sql = 'COPY %s (%s) FROM STDIN' % (quote_name(table), ', '.join([quote_name(column) for column in columns]))
+    cursor.copy_expert(sql, IterFile(format_rows(rows, chunk_size or BULK_CHUNK_SIZE)))
+
+
+def prepare_rows(fields, rows):
+    '''
+    Convert values of rows to DB values by fields (timezones of datetimes, etc.).
+    Integers are passed as is, other values are converted once for every distinct value
+    '''
+    cache = {}
+    for row in rows:
+        values = []
+        for field, value in izip(fields, row):
+            if value is not None and not isinstance(value, (int, long)):
+                try:
+                    value = cache[field, value]
+                except KeyError:
+                    value = cache[field, value] = field.get_db_prep_save(value, connection)
+            values.append(value)
+        yield values
+
+
+def bulk_insert(model, fields, rows, chunk_size=None):
+    '''
+    Insert rows of values of `fields` to the table of `model`.
+    Values of foreign keys are primary keys of related objects.
+    PostgreSQL uses COPY, other backends - bulk_create by chunks
+    '''
+    fields = [model._meta.get_field(name) for name in fields]
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+
+    if is_postgresql():
+        copy_rows(connection.cursor(), model._meta.db_table, [field.column for field in fields],
+                  prepare_rows(fields, rows), chunk_size)
+    else:
+        names = [field.attname for field in fields]
+        for chunk in chunks(rows, chunk_size):
+            model.objects.bulk_create([model(**dict(zip(names, row))) for row in chunk])
+
+
+def create_ids_table(cursor, table, ids):
+    '''
+    Create temporary table with unique ids for joining with it.
+    Table lives until the end of session, table left after failure is replaced
+    '''
+    drop_table(cursor, table)
+    cursor.execute('CREATE TEMP TABLE %s (user_id integer PRIMARY KEY)' % table)
+    copy_rows(cursor, table, ['user_id'], ((id,) for id in sorted_unique(ids)))
+    cursor.execute('ANALYZE %s' % table)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from array import array
+from urllib import urlencode
+import httplib
+import json
+import logging
+import re
+import socket
+import threading
+
+from django.conf import settings
+from vkontakte_api.api import VkontakteError
+
+from .ids import empty, from_numpy, numpy, TYPECODE
+
+log = logging.getLogger('vkontakte_groups_migration')
+
+HTTP_CLIENT = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_HTTP_CLIENT', False)
+REQUEST_TIMEOUT = getattr(settings, 'VKONTAKTE_API_REQUEST_TIMEOUT', 1)
+
+USERS_RE = re.compile(r'"users"\s*:\s*\[([^\]]*)\]')
+COUNT_RE = re.compile(r'"count"\s*:\s*(\d+)')
+
+
+def parse_ids(data):
+    '''
+    Parse comma separated ids to array('I') without making list of python ints
+    '''
+    if not data.strip():
+        return empty()
+    if numpy:
+        return from_numpy(numpy.fromstring(data, dtype=numpy.int64, sep=','))
+    return array(TYPECODE, map(int, data.split(',')))
+
+
+def parse_response(body):
+    data = json.loads(body)
+    if 'error' in data:
+        raise VkontakteError(data['error'])
+    return data['response']
+
+
+def parse_members_response(body):
+    '''
+    Parse response of groups.getMembers, users are returned as array('I')
+    '''
+    users = USERS_RE.search(body)
+    count = COUNT_RE.search(body)
+    if not users or not count:
+        # error or unexpected format of response
+        return parse_response(body)
+    return {'count': int(count.group(1)), 'users': parse_ids(users.group(1))}
+
+
+class HttpClient(object):
+    '''
+    Client of VK API with keep-alive connections, one connection per thread.
+    Could be used as backend of TokenPool. Members of groups.getMembers
+    are parsed directly to compact array('I') instead of list from JSON
+    '''
+    host = 'api.vk.com'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or REQUEST_TIMEOUT
+        self.local = threading.local()
+
+    def make_connection(self):
+        return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+
+    def get_connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.make_connection()
+        return self.local.connection
+
+    def close(self):
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    def request(self, method, params):
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive',
+        }
+        for attempt in range(2):
+            connection = self.get_connection()
+            try:
+                connection.request('POST', '/method/%s' % method, urlencode(params), headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                # connection was closed by server, open new one
+                self.close()
+                if attempt:
+                    raise
+                log.debug('Reconnecting to %s after error: %s' % (self.host, e))
+
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+        if not (200 <= response.status <= 299):
+            raise VkontakteError({'error_code': response.status, 'error_msg': 'HTTP error', 'request_params': params})
+        return body
+
+    def __call__(self, token, method, **kwargs):
+        body = self.request(method, dict(kwargs, access_token=token))
+        if method == 'groups.getMembers':
+            return parse_members_response(body)
+        return parse_response(body)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from django.db import connection
+
+
+def is_postgresql():
+    return connection.vendor == 'postgresql'
+
+
+def quote_name(name):
+    return connection.ops.quote_name(name)
+
+
+def drop_table(cursor, table):
+    cursor.execute('DROP TABLE IF EXISTS %s' % table)
+
+
+def get_indexes(table):
+    '''
+    Returns definitions of indexes of the table, only postgres
+    '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT indexdef FROM pg_indexes WHERE tablename = %s', [table])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def has_exclusion_constraint(table):
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'x'", [table])
+    return cursor.fetchone()[0] > 0
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from vkontakte_api.api import api_call
+
+log = logging.getLogger('vkontakte_groups_migration')
+
+THREADS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_THREADS', 1)
+REQUESTS_PER_SECOND = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_REQUESTS_PER_SECOND', 3)
+EXECUTE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_EXECUTE', False)
+DRIFT_AWARE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_DRIFT_AWARE', False)
+
+# max number of API calls inside one `execute` request
+EXECUTE_CALLS_LIMIT = 25
+
+
+class RateLimiter(object):
+    '''
+    Thread-safe limiter of number of calls per second
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0
+        self.next_time = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            self.calls += 1
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MembersFetcher(object):
+    '''
+    Fetcher of group members page by page. Yields tuples (offset, ids, count)
+    '''
+    step = 1000
+
+    def __init__(self, group, rate=None, limiter=None, pool=None):
+        self.group = group
+        # limiter could be shared between fetchers of different groups, requests are limited by tokens of pool
+        self.limiter = limiter or RateLimiter(rate or (None if pool else REQUESTS_PER_SECOND))
+        self.pool = pool
+
+    def api_call(self, method, **kwargs):
+        if self.pool:
+            return self.pool.call(method, **kwargs)
+        return api_call(method, **kwargs)
+
+    def call(self, offset):
+        return self.api_call('groups.getMembers', gid=self.group.remote_id, offset=offset)
+
+    def fetch_page(self, offset):
+        self.limiter.wait()
+        response = self.call(offset)
+        return response['users'], response['count']
+
+    def pages(self, offset=0):
+        while True:
+            ids, count = self.fetch_page(offset)
+            log.debug('Call returned %s ids for group "%s" with offset %s' % (len(ids), self.group, offset))
+            if len(ids) == 0:
+                break
+            yield offset, ids, count
+            offset += self.step
+
+
+class ConcurrentMembersFetcher(MembersFetcher):
+    '''
+    Fetcher of group members, that requests pages in a bounded pool of threads.
+    First page reveals amount of members, after that pages of the rest offsets
+    are requested concurrently and yielded in order of offsets
+    '''
+
+    def __init__(self, group, threads=None, rate=None, **kwargs):
+        super(ConcurrentMembersFetcher, self).__init__(group, rate=rate, **kwargs)
+        self.threads = threads or THREADS
+        self.thread_connections = {}
+
+    def fetch_page_in_thread(self, offset):
+        # every thread opens own connection, if api_call uses DB for getting tokens
+        self.thread_connections[threading.current_thread().ident] = connections[DEFAULT_DB_ALIAS]
+        return self.fetch_page(offset)
+
+    def close_thread_connections(self):
+        '''
+        Close connections of threads once, when the pool is finished
+        '''
+        for wrapper in self.thread_connections.values():
+            # threads of the pool are finished, so connection is closed by the current thread
+            wrapper.allow_thread_sharing = True
+            wrapper.close()
+        self.thread_connections.clear()
+
+    def pages(self, offset=0):
+        ids, count = self.fetch_page(offset)
+        if len(ids) == 0:
+            return
+        yield offset, ids, count
+
+        offsets = range(offset + self.step, count, self.step)
+        # window of requested pages limits memory used by fetched, but not yielded pages
+        window = self.threads * 4
+        pool = ThreadPool(self.threads)
+        try:
+            for i in range(0, len(offsets), window):
+                batch = offsets[i:i + window]
+                for page_offset, (ids, page_count) in izip(batch, pool.imap(self.fetch_page_in_thread, batch)):
+                    log.debug('Call returned %s ids for group "%s" with offset %s' % (len(ids), self.group, page_offset))
+                    if len(ids) == 0:
+                        return
+                    yield page_offset, ids, page_count
+        finally:
+            pool.terminate()
+            pool.join()
+            self.close_thread_connections()
+
+        # members could join the group during fetching
+        offset = offsets[-1] + self.step if offsets else offset + self.step
+        for page in super(ConcurrentMembersFetcher, self).pages(offset):
+            yield page
+
+
+class ExecuteMembersFetcher(MembersFetcher):
+    '''
+    Fetcher of group members, that packs up to 25 pages into one `execute` request
+    '''
+
+    def __init__(self, group, calls=EXECUTE_CALLS_LIMIT, **kwargs):
+        super(ExecuteMembersFetcher, self).__init__(group, **kwargs)
+        self.calls = min(calls, EXECUTE_CALLS_LIMIT)
+
+    def get_code(self, offsets):
+        return 'return [%s];' % ','.join(['API.groups.getMembers({"gid": %d, "offset": %d})' % (self.group.remote_id, offset)
+                                          for offset in offsets])
+
+    def fetch_pages(self, offsets):
+        self.limiter.wait()
+        responses = self.api_call('execute', code=self.get_code(offsets))
+        for offset, response in izip(offsets, responses):
+            if isinstance(response, dict):
+                yield response['users'], response['count']
+            else:
+                # failed call inside execute returns false
+                log.warning('Call inside execute failed for group "%s" with offset %s, fetch it again' % (self.group, offset))
+                yield self.fetch_page(offset)
+
+    def pages(self, offset=0):
+        count = None
+        while True:
+            # amount of members is unknown before the first response
+            stop = offset + self.calls * self.step if count is None else min(offset + self.calls * self.step, max(count, offset) + self.step)
+            offsets = range(offset, stop, self.step)
+            for offset, (ids, count) in izip(offsets, self.fetch_pages(offsets)):
+                log.debug('Call returned %s ids for group "%s" with offset %s' % (len(ids), self.group, offset))
+                if len(ids) == 0:
+                    return
+                yield offset, ids, count
+            offset += self.step
+
+
+class DriftAwareFetcher(object):
+    '''
+    Wrapper of fetcher, that watches for shifts of pages while members join and leave the group.
+    Members are returned sorted by id, so if amount of members changed between two pages
+    and the first id of the page is greater than the last id of the previous page,
+    some members could be missed at the boundary. Only the window before this boundary
+    is fetched again, until it overlaps with the previous page. Doubles at the boundaries are removed
+    '''
+    max_refetches = 10
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.group = fetcher.group
+        self.step = fetcher.step
+        self.refetches = 0
+
+    def fill_gap(self, offset, ids, prev_last_id, shift):
+        '''
+        Returns ids of the page with members missed between `prev_last_id` and the page
+        '''
+        missed = set()
+        for i in range(self.max_refetches):
+            # window should include the last id of the previous page
+            window_offset = max(offset - shift - 1, 0)
+            window = self.fetcher.fetch_page(window_offset)[0]
+            self.refetches += 1
+            missed.update([id for id in window if prev_last_id < id < ids[0]])
+            if not window or window[0] <= prev_last_id or window_offset == 0:
+                break
+            shift *= 2
+        else:
+            log.warning('Gap in members of group "%s" before offset %s was not filled after %s refetches'
+                        % (self.group, offset, self.max_refetches))
+
+        if missed:
+            log.debug('Found %s missed ids of group "%s" before offset %s' % (len(missed), self.group, offset))
+        return sorted(missed) + list(ids)
+
+    def pages(self, offset=0):
+        prev_last_id = prev_count = None
+        for offset, ids, count in self.fetcher.pages(offset):
+            if prev_last_id is not None and len(ids):
+                if count != prev_count and ids[0] > prev_last_id:
+                    ids = self.fill_gap(offset, ids, prev_last_id, abs(count - prev_count))
+                if ids[0] <= prev_last_id:
+                    # members joined before the boundary shifted the page to the right
+                    ids = [id for id in ids if id > prev_last_id]
+            if len(ids):
+                prev_last_id = ids[-1]
+            prev_count = count
+            yield offset, ids, count
+
+
+def get_members_fetcher(group, threads=None, execute=None, drift_aware=None, limiter=None, pool=None,
+                        http_client=None):
+    '''
+    Returns fetcher of members according to arguments and settings
+    '''
+    from .tokens import get_token_pool
+
+    threads = THREADS if threads is None else threads
+    execute = EXECUTE if execute is None else execute
+    drift_aware = DRIFT_AWARE if drift_aware is None else drift_aware
+
+    if pool is None:
+        pool = get_token_pool(http_client)
+    if pool and limiter is None:
+        # requests per second are limited by every token of the pool
+        limiter = RateLimiter(None)
+
+    if execute:
+        fetcher = ExecuteMembersFetcher(group, limiter=limiter, pool=pool)
+    elif threads > 1:
+        fetcher = ConcurrentMembersFetcher(group, threads=threads, limiter=limiter, pool=pool)
+    else:
+        fetcher = MembersFetcher(group, limiter=limiter, pool=pool)
+
+    if drift_aware:
+        fetcher = DriftAwareFetcher(fetcher)
+    return fetcher
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from base64 import b64decode, b64encode
+
+from django.conf import settings
+from django.db import models
+from django.db.models.fields.subclassing import Creator
+
+from . import ids
+
+IDS_COMPRESSION = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_IDS_COMPRESSION', 'zlib')
+
+
+class RestoringCreator(Creator):
+    '''
+    Value, that is not stored in DB, is restored by method of the model on the first access
+    '''
+    def __get__(self, obj, type=None):
+        value = super(RestoringCreator, self).__get__(obj, type)
+        if value is None:
+            value = obj.__dict__[self.field.name] = getattr(obj, self.field.restore)()
+        return value
+
+
+class IdsField(models.Field):
+    '''
+    Field for storing list of VK ids as a compact binary string.
+    Ids are sorted and deduplicated while saving, value from DB is sorted array('I').
+    If `stored` attribute of the model is False, value is not saved and restored by `restore` method of the model
+    '''
+    __metaclass__ = models.SubfieldBase
+
+    description = 'Sorted list of ids'
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        self.stored = kwargs.pop('stored', None)
+        self.restore = kwargs.pop('restore', None)
+        super(IdsField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(IdsField, self).contribute_to_class(cls, name)
+        if self.restore:
+            # descriptor of SubfieldBase is set after this method, so it's replaced when the model is prepared
+            def set_descriptor(sender, **kwargs):
+                setattr(sender, self.name, RestoringCreator(self))
+            models.signals.class_prepared.connect(set_descriptor, sender=cls, weak=False)
+
+    def pre_save(self, model_instance, add):
+        if self.stored and not getattr(model_instance, self.stored):
+            return None
+        return super(IdsField, self).pre_save(model_instance, add)
+
+    def db_type(self, connection):
+        return {
+            'postgresql': 'bytea',
+            'mysql': 'longblob',
+        }.get(connection.vendor, 'blob')
+
+    def get_default(self):
+        return []
+
+    def to_python(self, value):
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        elif isinstance(value, buffer):
+            value = str(value)
+        elif isinstance(value, unicode):
+            # serialized value
+            value = b64decode(value)
+
+        if isinstance(value, str):
+            return ids.decode(value)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        return buffer(ids.encode(value, IDS_COMPRESSION))
+
+    def get_prep_lookup(self, lookup_type, value):
+        if lookup_type != 'isnull':
+            raise TypeError('Lookup type %s is not supported.' % lookup_type)
+        return super(IdsField, self).get_prep_lookup(lookup_type, value)
+
+    def value_to_string(self, obj):
+        return unicode(b64encode(ids.encode(self._get_val_from_obj(obj), IDS_COMPRESSION)))
+
+try:
+    from south.modelsinspector import add_introspection_rules
+    add_introspection_rules([], ["^vkontakte_groups_migration\.fields\.IdsField"])
+except ImportError:
+    pass
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+'''
+Compact binary representation of lists of VK ids.
+
+Ids are positive integers below 2**32. They are stored sorted and deduplicated
+as deltas between neighbours, every delta is written as a varint (7 bits per byte,
+high bit means "more bytes follow"). The resulting stream is optionally compressed.
+First byte of every encoded value is the compression marker.
+
+NumPy is used for vectorized encoding/decoding if it's installed,
+otherwise pure-python implementation is used.
+'''
+from array import array
+from itertools import chain, islice, izip
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+except ImportError:
+    try:
+        from lz4 import compress as lz4_compress, decompress as lz4_decompress
+    except ImportError:
+        lz4_compress = lz4_decompress = None
+
+TYPECODE = 'I'
+MAX_ID = 2 ** 32 - 1
+
+# checksum of ids is sum of their hashes (id * multiplier) % modulus, product fits into signed bigint of DB
+CHECKSUM_MULTIPLIER = 2147483647
+CHECKSUM_MODULUS = 4294967291
+
+COMPRESSION_NONE = '\x00'
+COMPRESSION_ZLIB = '\x01'
+COMPRESSION_LZ4 = '\x02'
+
+COMPRESSIONS = {
+    None: COMPRESSION_NONE,
+    'zlib': COMPRESSION_ZLIB,
+    'lz4': COMPRESSION_LZ4,
+}
+
+
+def empty():
+    return array(TYPECODE)
+
+
+def check_range(min_id, max_id):
+    if min_id < 0 or max_id > MAX_ID:
+        raise ValueError("Ids should be in range from 0 to %d" % MAX_ID)
+
+
+def to_numpy(ids):
+    '''
+    Convert sequence of ids to numpy uint32 array without copying if it's possible
+    '''
+    if isinstance(ids, numpy.ndarray):
+        if ids.dtype != numpy.uint32 and len(ids):
+            check_range(ids.min(), ids.max())
+        return ids.astype(numpy.uint32, copy=False)
+    if isinstance(ids, array) and ids.typecode == TYPECODE and ids.itemsize == 4:
+        return numpy.frombuffer(ids, dtype=numpy.uint32) if len(ids) else numpy.empty(0, dtype=numpy.uint32)
+
+    ids = numpy.array(ids if isinstance(ids, (list, tuple)) else list(ids), dtype=numpy.int64)
+    if len(ids):
+        check_range(ids.min(), ids.max())
+    return ids.astype(numpy.uint32)
+
+
+def from_numpy(ids):
+    result = empty()
+    result.fromstring(ids.astype(numpy.uint32).tostring())
+    return result
+
+
+def sorted_unique(ids):
+    '''
+    Return sorted array of unique ids
+    '''
+    if numpy:
+        ids = to_numpy(ids)
+        if (ids[1:] > ids[:-1]).all():
+            return from_numpy(ids)
+        return from_numpy(numpy.unique(ids))
+    if isinstance(ids, array) and _is_sorted_unique(ids):
+        return ids
+    ids = sorted(set(ids))
+    if ids:
+        check_range(ids[0], ids[-1])
+    return array(TYPECODE, ids)
+
+
+def _is_sorted_unique(ids):
+    return all(a < b for a, b in izip(ids, islice(ids, 1, None)))
+
+
+def difference(ids1, ids2):
+    '''
+    Return sorted array of ids from `ids1`, that are absent in `ids2`.
+    It's much cheaper than difference of python sets for millions of ids
+    '''
+    ids1 = sorted_unique(ids1)
+    ids2 = sorted_unique(ids2)
+
+    if numpy:
+        ids1 = to_numpy(ids1)
+        return from_numpy(ids1[~_contains_numpy(to_numpy(ids2), ids1)])
+
+    # linear merge of sorted arrays
+    result = empty()
+    ids2 = iter(ids2)
+    value2 = next(ids2, None)
+    for value1 in ids1:
+        while value2 is not None and value2 < value1:
+            value2 = next(ids2, None)
+        if value1 != value2:
+            result.append(value1)
+    return result
+
+
+def union(ids1, ids2):
+    '''
+    Return sorted array of unique ids from `ids1` and `ids2`
+    '''
+    if numpy:
+        return from_numpy(numpy.union1d(to_numpy(ids1), to_numpy(ids2)))
+    return sorted_unique(chain(ids1, ids2))
+
+
+def _contains_numpy(ids1, ids2):
+    '''
+    Return mask of sorted array `ids2`, that is True for ids present in sorted array `ids1`
+    '''
+    if not len(ids1) or not len(ids2):
+        return numpy.zeros(len(ids2), dtype=bool)
+    # both arrays are sorted, so binary search is enough instead of sorting of concatenated arrays
+    indexes = numpy.searchsorted(ids1, ids2).clip(max=len(ids1) - 1)
+    return ids1[indexes] == ids2
+
+
+def periods(snapshots):
+    '''
+    Calculate periods of presence of ids in the sequence of snapshots of ids in one pass.
+    Every time ids disappear from the snapshot, it yields tuple (ids, indexes of snapshots where they appeared,
+    index of snapshot where they disappeared), ids of the last snapshot are yielded with None as the last index.
+    Only the previous snapshot and indexes of its ids are kept in memory
+    '''
+    if numpy:
+        prev = entered = None
+        for index, ids in enumerate(snapshots):
+            ids = to_numpy(sorted_unique(ids))
+            if prev is None:
+                prev, entered = ids, numpy.zeros(len(ids), dtype=numpy.intp)
+                continue
+            present = _contains_numpy(ids, prev)
+            yield prev[~present].tolist(), entered[~present].tolist(), index
+            # ids of both snapshots are sorted, so indexes of remained ids are in the same order
+            remained = _contains_numpy(prev, ids)
+            indexes = numpy.empty(len(ids), dtype=numpy.intp)
+            indexes[remained] = entered[present]
+            indexes[~remained] = index
+            prev, entered = ids, indexes
+        if prev is not None:
+            yield prev.tolist(), entered.tolist(), None
+        return
+
+    prev = None
+    entered = {}
+    for index, ids in enumerate(snapshots):
+        ids = sorted_unique(ids)
+        if prev is not None:
+            left_ids = difference(prev, ids)
+            yield list(left_ids), [entered.pop(id) for id in left_ids], index
+        for id in (difference(ids, prev) if prev is not None else ids):
+            entered[id] = index
+        prev = ids
+    if prev is not None:
+        yield list(prev), [entered[id] for id in prev], None
+
+
+def checksum(ids):
+    '''
+    Order-independent checksum of ids, that could be calculated by aggregate query in DB
+    '''
+    if numpy:
+        ids = to_numpy(ids).astype(numpy.uint64)
+        return int(((ids * CHECKSUM_MULTIPLIER) % CHECKSUM_MODULUS).sum())
+    return sum([(value * CHECKSUM_MULTIPLIER) % CHECKSUM_MODULUS for value in ids])
+
+
+def _encode_varints_numpy(ids):
+    ids = to_numpy(ids)
+    if not len(ids):
+        return ''
+
+    deltas = numpy.empty(len(ids), dtype=numpy.uint32)
+    deltas[0] = ids[0]
+    numpy.subtract(ids[1:], ids[:-1], out=deltas[1:])
+
+    # uint32 value takes from 1 to 5 bytes
+    sizes = numpy.ones(len(deltas), dtype=numpy.intp)
+    for bits in (7, 14, 21, 28):
+        sizes += deltas >= (1 << bits)
+    ends = numpy.cumsum(sizes)
+    starts = ends - sizes
+
+    result = numpy.empty(ends[-1], dtype=numpy.uint8)
+    for i in range(5):
+        mask = sizes > i
+        if not mask.any():
+            break
+        chunk = (deltas[mask] >> (7 * i)) & 0x7f
+        chunk |= (sizes[mask] > i + 1).astype(numpy.uint32) << 7
+        result[starts[mask] + i] = chunk
+    return result.tostring()
+
+
+def _decode_varints_numpy(data):
+    if not data:
+        return empty()
+
+    chunks = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero((chunks & 0x80) == 0)
+    if not len(ends) or ends[-1] != len(chunks) - 1:
+        raise ValueError("Truncated varint stream")
+
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    sizes = ends - starts + 1
+
+    deltas = (chunks[starts] & 0x7f).astype(numpy.uint32)
+    for i in range(1, 5):
+        mask = sizes > i
+        if not mask.any():
+            break
+        deltas[mask] |= (chunks[starts[mask] + i] & 0x7f).astype(numpy.uint32) << (7 * i)
+    return from_numpy(numpy.cumsum(deltas, dtype=numpy.uint32))
+
+
+def _encode_varints_python(ids):
+    result = bytearray()
+    prev = 0
+    for value in ids:
+        delta = value - prev
+        prev = value
+        while delta >= 0x80:
+            result.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        result.append(delta)
+    return str(result)
+
+
+def _decode_varints_python(data):
+    result = empty()
+    prev = value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            prev += value
+            result.append(prev)
+            value = shift = 0
+    if shift:
+        raise ValueError("Truncated varint stream")
+    return result
+
+
+def encode(ids, compression=None):
+    '''
+    Encode sequence of ids to the binary string. Ids are sorted and deduplicated before encoding
+    '''
+    try:
+        marker = COMPRESSIONS[compression]
+    except KeyError:
+        raise ValueError("Unknown compression '%s', should be one of %s" % (compression, COMPRESSIONS.keys()))
+
+    ids = sorted_unique(ids)
+    data = _encode_varints_numpy(ids) if numpy else _encode_varints_python(ids)
+
+    if marker == COMPRESSION_ZLIB:
+        data = zlib.compress(data)
+    elif marker == COMPRESSION_LZ4:
+        if not lz4_compress:
+            raise ValueError("Module lz4 is not installed")
+        data = lz4_compress(data)
+
+    return marker + data
+
+
+def decode(data):
+    '''
+    Decode binary string to the sorted array of ids
+    '''
+    if not data:
+        return empty()
+
+    marker, data = data[0], data[1:]
+    if marker == COMPRESSION_ZLIB:
+        data = zlib.decompress(data)
+    elif marker == COMPRESSION_LZ4:
+        if not lz4_decompress:
+            raise ValueError("Module lz4 is not installed")
+        data = lz4_decompress(data)
+    elif marker != COMPRESSION_NONE:
+        raise ValueError("Unknown compression marker %r" % marker)
+
+    return _decode_varints_numpy(data) if numpy else _decode_varints_python(data)
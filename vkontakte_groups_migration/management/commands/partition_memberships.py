@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from vkontakte_groups_migration.models import GroupMembership, clear_memberships_constraints
+from vkontakte_groups_migration.partitions import HASH_PARTITIONS, PARTITIONING, STRATEGIES, get_partitioning, \
+    partition_table, unpartition_table
+
+
+class Command(BaseCommand):
+    help = 'Convert table of memberships to the table partitioned by groups or back to the ordinary table'
+    option_list = BaseCommand.option_list + (
+        make_option('--strategy', action='store', dest='strategy', default=PARTITIONING,
+                    help='Strategy of partitioning: %s' % ' or '.join(STRATEGIES.values())),
+        make_option('--partitions', action='store', dest='partitions', type='int', default=HASH_PARTITIONS,
+                    help='Number of partitions for hash strategy'),
+        make_option('--undo', action='store_true', dest='undo', default=False,
+                    help='Convert partitioned table back to the ordinary table'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        table = GroupMembership._meta.db_table
+        try:
+            if options['undo']:
+                unpartition_table(cursor, table)
+            else:
+                partition_table(cursor, table, options['strategy'], options['partitions'])
+        except (ValueError, NotImplementedError), e:
+            raise CommandError(e)
+        # constraints of memberships are changed with the table
+        clear_memberships_constraints()
+        self.stdout.write('Partitioning of memberships: %s\n' % get_partitioning(cursor, table))
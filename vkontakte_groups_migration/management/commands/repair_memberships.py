@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from vkontakte_groups.models import Group
+
+from vkontakte_groups_migration.models import GroupMembership
+
+
+class Command(BaseCommand):
+    help = 'Merge duplicated and overlapping memberships. Run it before migration, that creates constraints of memberships'
+    option_list = BaseCommand.option_list + (
+        make_option('--group', action='store', dest='group', default=None,
+                    help='Remote ID of group, all groups by default'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='Rebuild memberships of the group from its migrations'),
+    )
+
+    def handle(self, *args, **options):
+        group = Group.objects.get(remote_id=options['group']) if options['group'] else None
+        if options['rebuild']:
+            if not group:
+                raise CommandError('Group should be specified for rebuilding of memberships')
+            GroupMembership.objects.rebuild_timeline(group)
+            self.stdout.write('Memberships of group %s rebuilt\n' % group)
+            return
+
+        try:
+            count = GroupMembership.objects.repair(group)
+        except NotImplementedError, e:
+            raise CommandError(e)
+        self.stdout.write('%d duplicated or overlapping memberships merged\n' % count)
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+from bisect import bisect_left, bisect_right
 from datetime import timedelta
+from functools import wraps
+from itertools import izip
 import logging
+import threading
+import time
 
 from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
@@ -9,15 +14,33 @@ from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.db.utils import IntegrityError
 from django.utils import timezone
-from vkontakte_api import fields
-from vkontakte_api.decorators import opt_generator, memoize
-from vkontakte_api.api import api_call
+from vkontakte_api.decorators import opt_generator
 from vkontakte_groups.models import Group
 from vkontakte_users.models import User
 
+from .bulk import bulk_insert, chunks, copy_rows, create_ids_table, prepare_rows
+from .db import drop_table, get_indexes, has_exclusion_constraint, is_postgresql, quote_name
+from .fetchers import get_members_fetcher
+from .fields import IdsField
+from .ids import CHECKSUM_MODULUS, CHECKSUM_MULTIPLIER, checksum, difference, empty, periods, sorted_unique, union
+from .partitions import create_partition, get_cached_partitions, get_partition_name, get_partitions, replace_partition, \
+    truncate_partition
+from .snapshots import get_members_ids, snapshots
+from .spill import IdsSpill
+
 log = logging.getLogger('vkontakte_groups_migration')
 
+# changes of members of visible migrations, deleted by queryset or cascade in the current thread, by groups
+deleted_migrations = threading.local()
+
 FETCH_ONLY_EXPIRED_USERS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_FETCH_ONLY_EXPIRED_USERS', True)
+STREAMING = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_STREAMING', False)
+CHECKPOINT_PAGES = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_CHECKPOINT_PAGES', 100)
+CHECKPOINT_SECONDS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_CHECKPOINT_SECONDS', 60)
+SEQUENCE_TIMELINE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_SEQUENCE_TIMELINE', False)
+KEYFRAME_INTERVAL = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_KEYFRAME_INTERVAL', None)
+FINALIZE_BATCH_SIZE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_FINALIZE_BATCH_SIZE', 10)
+CONSTRAINTS_TIMEOUT = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_CONSTRAINTS_TIMEOUT', 600)
 
 
 class WrongMembershipsAmmount(Exception):
@@ -30,6 +53,9 @@ class EnteredMembersAreNotLeft(Exception):
 class LeftMembersNotInTheGroup(Exception):
     pass
 
+class MembersNotRestored(Exception):
+    pass
+
 def update_group_users(group):
     '''
     Fetch all users of group, make new m2m relations, remove old m2m relations
@@ -106,9 +132,16 @@ class GroupMigrationQueryset(object):
 class GroupMigrationManager(models.Manager, GroupMigrationQueryset):
 
     @opt_generator
-    def update_for_group(self, group, offset=0):
+    def update_for_group(self, group, offset=0, streaming=None, threads=None, execute=None, drift_aware=None,
+                         fetcher=None):
         '''
         Fetch all users for this group, save them as IDs and after make m2m relations
+        In streaming mode fetched IDs are kept in the temporary file instead of memory
+        Fetched IDs are saved to checkpoints periodically, unfinished migration continues from the last one
+        If `threads` more than 1, pages are fetched concurrently
+        If `execute` is True, pages are fetched by batches using `execute` method
+        If `drift_aware` is True, windows shifted by joined and left members are fetched again
+        If `fetcher` is given, pages are fetched by it instead of fetcher made from arguments above
         '''
         try:
             stat, created = self.get_or_create(group=group, time=None)
@@ -120,31 +153,244 @@ class GroupMigrationManager(models.Manager, GroupMigrationQueryset):
         if created:
             stat.set_defaults()
 
-        offset = offset or stat.offset
+        if STREAMING if streaming is None else streaming:
+            spill = IdsSpill()
+            spill.extend(stat.members_ids)
+            stat.members_ids = spill
 
-        offset_step = 1000
-        while True:
-            response = api_call('groups.getMembers', gid=group.remote_id, offset=offset)
-            ids = response['users']
-            log.debug('Call returned %s ids for group "%s" with offset %s, now members_ids %s' %
-                      (len(ids), group, offset, len(stat.members_ids)))
+        # restore ids of unfinished migration
+        for checkpoint in stat.checkpoints.order_by('offset'):
+            stat.members_ids.extend(checkpoint.members_ids)
 
-            if len(ids) == 0:
-                break
+        offset = offset or stat.offset
 
+        if fetcher is None:
+            fetcher = get_members_fetcher(group, threads=threads, execute=execute, drift_aware=drift_aware)
+
+        checkpoint_ids = empty()
+        checkpoint_pages = 0
+        checkpoint_time = time.time()
+        for page_offset, ids, count in fetcher.pages(offset):
             # add new ids to group stat members
-            stat.members_ids += ids
-            stat.offset = offset
-#            stat.save()
-            offset += offset_step
-            yield (offset + len(ids), response['count'], offset_step)
+            stat.members_ids.extend(ids)
+            checkpoint_ids.extend(ids)
+            checkpoint_pages += 1
+            offset = page_offset + fetcher.step
+
+            if checkpoint_pages >= CHECKPOINT_PAGES or time.time() - checkpoint_time >= CHECKPOINT_SECONDS:
+                stat.save_checkpoint(offset, checkpoint_ids)
+                checkpoint_ids = empty()
+                checkpoint_pages = 0
+                checkpoint_time = time.time()
+
+            yield (offset + len(ids), count, fetcher.step)
 
         # save stat with time and other fields
         stat.time = timezone.now()
         stat.save_final()
+        stat.checkpoints.all().delete()
         signals.group_migration_updated.send(sender=GroupMigration, instance=stat)
 
 
+    def keep_keyframes_chain(self, group_id):
+        '''
+        Make keyframes of remaining migrations, which members were restored through migrations deleted by queryset
+        or cascade. Members are restored once for every gap between remaining migrations
+        and nothing is restored, if all later migrations of the group are deleted too
+        '''
+        deleted = getattr(deleted_migrations, 'groups', {}).pop(group_id, None)
+        if not deleted:
+            return
+        snapshots.invalidate(group_id)
+
+        # deleting of remembered migrations could be rolled back
+        remaining = set(self.filter(pk__in=[migration[0] for migration in deleted]).values_list('pk', flat=True))
+        deleted = sorted([migration for migration in deleted if migration[0] not in remaining],
+                         key=lambda migration: migration[1])
+
+        while deleted:
+            next_stat = (list(self.visible.filter(group=group_id, time__gt=deleted[0][1]).order_by('time')[:1]) or [None])[0]
+            gap = [migration for migration in deleted if not next_stat or migration[1] < next_stat.time]
+            deleted = deleted[len(gap):]
+            if not next_stat or next_stat.keyframe:
+                continue
+
+            prev = (list(self.visible.light.filter(group=group_id, time__lt=gap[0][1]).order_by('-time')[:1]) or [None])[0]
+            members_ids = get_members_ids(prev) if prev else empty()
+            for pk, deleted_time, keyframe_ids, entered_ids, left_ids in gap:
+                members_ids = keyframe_ids if keyframe_ids is not None else union(difference(members_ids, left_ids), entered_ids)
+            members_ids = union(difference(members_ids, next_stat.members_left_ids), next_stat.members_entered_ids)
+
+            if len(members_ids) != next_stat.members_count \
+                    or next_stat.members_checksum is not None and checksum(members_ids) != next_stat.members_checksum:
+                raise MembersNotRestored("Restored members (%d) are not equal to members (%d) of migration %s of group %s" % (
+                    len(members_ids), next_stat.members_count, next_stat.pk, group_id))
+            self.filter(pk=next_stat.pk).update(keyframe=True, members_ids=members_ids)
+
+    def finalize(self, migrations, batch_size=None):
+        '''
+        Finalize backlog of migrations of one group, it's the same as save_final of every migration in time order.
+        Migrations share one timeline, so members of the previous migration are already in memory.
+        Migration is compared with neighbours, when the next one is updated, and memberships are written
+        by batches of `batch_size` migrations. If `migrations` is a queryset, they are loaded by batches,
+        so only members of the current batch are kept in memory
+        '''
+        batch_size = batch_size or FINALIZE_BATCH_SIZE
+        if isinstance(migrations, QuerySet):
+            pks = list(migrations.order_by('time').values_list('pk', flat=True))
+            migrations = (migration for pks_chunk in chunks(pks, batch_size)
+                          for migration in self.filter(pk__in=pks_chunk).order_by('time'))
+        else:
+            migrations = sorted(migrations, key=lambda migration: migration.time)
+
+        group = timeline = updated = None
+        # compared migrations, which memberships are not written yet
+        pending = []
+        consistent = True
+        sequence_last = None
+        try:
+            for migration in migrations:
+                if timeline is None:
+                    group = migration.group
+                    timeline = MigrationTimeline(group)
+                    GroupMembership.objects.create_partition(group)
+                timeline.update(migration)
+                timeline.attach(migration)
+
+                migration.offset = 0
+                migration.clean_members()
+                migration.update()
+                migration.save()
+
+                if updated:
+                    pending.append(self.compare_finalized(updated))
+                if len(pending) > batch_size:
+                    # the last one could be hidden yet by comparing of the next migration
+                    written, pending = pending[:-1], pending[-1:]
+                    consistent = consistent and self.append_memberships(group, written, timeline)
+                    sequence_last = self.append_sequence(written, sequence_last)
+                updated = migration
+
+            if updated:
+                pending.append(self.compare_finalized(updated))
+                consistent = consistent and self.append_memberships(group, pending)
+                sequence_last = self.append_sequence(pending, sequence_last)
+
+            visible = [migration for migration in pending if not migration.hidden]
+            if not consistent:
+                GroupMembership.objects.fix_timeline(group)
+            elif visible and not visible[-1].next:
+                snapshots.put(group.pk, visible[-1].pk, visible[-1].members_ids)
+        finally:
+            if timeline:
+                timeline.active = False
+
+    def compare_finalized(self, migration):
+        migration.compare_with_statistic()
+        migration.compare_entered_left()
+        migration.compare_with_siblings()
+        return migration
+
+    def append_memberships(self, group, migrations, timeline=None):
+        '''
+        Write memberships of visible migrations, returns False if current memberships are inconsistent.
+        Written migrations are replaced in the timeline by light ones except the last,
+        which members are needed for the next batch
+        '''
+        visible = [migration for migration in migrations if not migration.hidden]
+        if not visible:
+            return True
+        try:
+            GroupMembership.objects.append_migrations(group, visible, visible[0].prev)
+        except WrongMembershipsAmmount, e:
+            log.warning(e)
+            return False
+
+        if timeline:
+            for migration in self.light.filter(pk__in=[migration.pk for migration in visible[:-1]]):
+                timeline.update(migration)
+        return True
+
+    def append_sequence(self, migrations, last=None):
+        if SEQUENCE_TIMELINE:
+            for migration in migrations:
+                GroupSequenceMembership.objects.append(migration, last)
+                if migration.sequence is not None:
+                    last = migration
+        return last
+
+
+class MigrationTimeline(object):
+    '''
+    Visible migrations of the group, loaded once without lists of ids and linked with neighbours in memory.
+    Migrations of the timeline share it, so hiding of one of them is seen by others
+    '''
+
+    def __init__(self, group):
+        self.group = group
+        self.active = True
+        self.migrations = []
+        self.times = []
+        for migration in group.migrations.visible.light.order_by('time'):
+            self.append(migration)
+
+    def __len__(self):
+        return len(self.migrations)
+
+    def __iter__(self):
+        return iter(self.migrations)
+
+    def append(self, migration):
+        self.migrations.append(self.attach(migration))
+        self.times.append(migration.time)
+
+    def attach(self, migration):
+        migration._timeline = self
+        return migration
+
+    def get_prev(self, migration, step=0):
+        index = bisect_left(self.times, migration.time) - 1 - step
+        return self.migrations[index] if index >= 0 else None
+
+    def get_next(self, migration, step=0):
+        index = bisect_right(self.times, migration.time) + step
+        return self.migrations[index] if index < len(self.migrations) else None
+
+    def update(self, migration):
+        '''
+        Update position of the migration after saving, it's removed if it's not visible anymore
+        '''
+        for index, item in enumerate(self.migrations):
+            if item.pk == migration.pk:
+                del self.migrations[index]
+                del self.times[index]
+                break
+
+        if not migration.hidden and migration.time is not None:
+            index = bisect_left(self.times, migration.time)
+            self.migrations.insert(index, self.attach(migration))
+            self.times.insert(index, migration.time)
+
+
+def with_timeline(method):
+    '''
+    Neighbours of migration are taken from the same timeline while method is running,
+    after that the timeline is dropped, because it could be changed by other processes
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._timeline is not None and self._timeline.active:
+            return method(self, *args, **kwargs)
+
+        self._timeline = MigrationTimeline(self.group)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._timeline.active = False
+            self._timeline = None
+    return wrapper
+
+
 class GroupMigration(models.Model):
 
     class Meta:
@@ -159,16 +405,21 @@ class GroupMigration(models.Model):
     time = models.DateTimeField(u'Дата и время', null=True, db_index=True)
 
     hidden = models.BooleanField(u'Скрыть', default=False, db_index=True)
+    # number of migration in the sequence timeline of the group, hidden migrations are numbered too
+    sequence = models.PositiveIntegerField(u'Порядковый номер', null=True, db_index=True)
 
     offset = models.PositiveIntegerField(default=0)
 
-    members_ids = fields.PickledObjectField(default=[])
-    members_entered_ids = fields.PickledObjectField(default=[])
-    members_left_ids = fields.PickledObjectField(default=[])
-    members_deactivated_entered_ids = fields.PickledObjectField(default=[])
-    members_deactivated_left_ids = fields.PickledObjectField(default=[])
-    members_has_avatar_entered_ids = fields.PickledObjectField(default=[])
-    members_has_avatar_left_ids = fields.PickledObjectField(default=[])
+    # members are stored only in keyframes, members of other migrations are restored by entered and left members
+    keyframe = models.BooleanField(u'Полный срез', default=True)
+
+    members_ids = IdsField(null=True, stored='keyframe', restore='restore_members_ids')
+    members_entered_ids = IdsField()
+    members_left_ids = IdsField()
+    members_deactivated_entered_ids = IdsField()
+    members_deactivated_left_ids = IdsField()
+    members_has_avatar_entered_ids = IdsField()
+    members_has_avatar_left_ids = IdsField()
 
     members_count = models.PositiveIntegerField(default=0)
     members_entered_count = models.PositiveIntegerField(default=0)
@@ -178,12 +429,25 @@ class GroupMigration(models.Model):
     members_has_avatar_entered_count = models.PositiveIntegerField(default=0)
     members_has_avatar_left_count = models.PositiveIntegerField(default=0)
 
+    members_checksum = models.BigIntegerField(null=True)
+
     objects = ModelQuerySetManager(GroupMigrationManager)
 
+    _timeline = None
+
+    @transaction.commit_on_success
+    def save_checkpoint(self, offset, ids):
+        '''
+        Save ids fetched since previous checkpoint and offset of the next page
+        without saving of all members_ids
+        '''
+        self.checkpoints.create(offset=offset, members_ids=ids)
+        self.__class__.objects.filter(pk=self.pk).update(offset=offset)
+        self.offset = offset
+
     def set_defaults(self):
         '''
-        It's neccesary to call after creating of every instance,
-        because `default` attribute of fields.PickledObjectField doesn't work properly
+        Reset all ids lists of instance
         '''
         self.members_ids = []
         self.members_entered_ids = []
@@ -201,15 +465,27 @@ class GroupMigration(models.Model):
     def prev(self):
         return self.get_prev()
 
+    @property
+    def timeline(self):
+        '''
+        Active timeline of the migration or None, see with_timeline
+        '''
+        if self._timeline is not None and self._timeline.active:
+            return self._timeline
+
     def get_next(self, step=0):
+        if self.timeline:
+            return self.timeline.get_next(self, step)
         try:
-            return self.group.migrations.visible.filter(time__gt=self.time).order_by('time')[step]
+            return self.group.migrations.visible.light.filter(time__gt=self.time).order_by('time')[step]
         except IndexError:
             return None
 
     def get_prev(self, step=0):
+        if self.timeline:
+            return self.timeline.get_prev(self, step)
         try:
-            return self.group.migrations.visible.filter(time__lt=self.time).order_by('-time')[step]
+            return self.group.migrations.visible.light.filter(time__lt=self.time).order_by('-time')[step]
         except IndexError:
             return None
 
@@ -234,6 +510,7 @@ class GroupMigration(models.Model):
         '''
         self.hide()
         super(GroupMigration, self).delete(*args, **kwargs)
+        snapshots.invalidate(self.group_id)
 
     def hide(self):
         '''
@@ -241,7 +518,9 @@ class GroupMigration(models.Model):
         '''
         self.hidden = True
         self.save()
+        snapshots.invalidate(self.group_id)
 
+    @with_timeline
     def fix_memberships(self):
         '''
         Fixes memberships timeline after hiding current migration
@@ -250,69 +529,66 @@ class GroupMigration(models.Model):
         if not self.hidden:
             return
 
+        snapshots.invalidate(self.group_id)
+
         if self.next:
             cursor = connection.cursor()
+            table = quote_name(GroupMembership._meta.db_table)
+            params = {
+                'group': self.group.pk,
+                'time': self.time,
+                'next_time': self.next.time,
+            }
+
+            # members of the next migration are shipped to DB once and all operations are joins with them
+            create_ids_table(cursor, 'vkontakte_groups_migration_next_ids', self.next.members_ids)
 
             # всем кто вышел сейчас и есть в следующей - проставляем нужную дату выхода
             # дату выхода берем из последнего отрезка и удаляем его
             # меняем даты выхода первого отрезка на даты выхода второго отрезка
+            # deleted second parts don't conflict with partial unique indexes while updating first parts
             cursor.execute('''
-                START TRANSACTION;
-
-                -- make temporary table, because of partial indexes cannot let do all operations in current table
-                CREATE TEMP TABLE vkontakte_groups_migration_groupmembership_temp AS
-                    SELECT second.group_id, second.user_id, second.time_entered, second.time_left
-                    FROM "vkontakte_groups_migration_groupmembership" AS second
-                    WHERE (second.time_entered = %(next_time_entered)s
-                        AND second.group_id = %(group)s
-                        AND second.user_id IN (
-                            SELECT first.user_id FROM "vkontakte_groups_migration_groupmembership" AS first
-                                WHERE (first.group_id = second.group_id
-                                    AND first.time_left = %(time_left)s
-                                    AND first.user_id IN %(members)s)));
-
-
-                -- remove second part of memberships users, who left in first part
-                DELETE FROM "vkontakte_groups_migration_groupmembership" AS second
-                    WHERE (second.time_entered = %(next_time_entered)s
-                        AND second.group_id = %(group)s
-                        AND second.user_id IN (
-                            SELECT first.user_id FROM "vkontakte_groups_migration_groupmembership" AS first
-                                WHERE (first.group_id = second.group_id
-                                    AND first.time_left = %(time_left)s
-                                    AND first.user_id IN %(members)s)));
-
-                -- update time_left of first part of memberships using temp table
-                UPDATE "vkontakte_groups_migration_groupmembership" AS first
+                WITH second AS (
+                    DELETE FROM %(table)s AS second
+                        USING %(table)s AS first, vkontakte_groups_migration_next_ids AS ids
+                        WHERE second.group_id = %%(group)s
+                          AND second.time_entered = %%(next_time)s
+                          AND first.group_id = second.group_id
+                          AND first.user_id = second.user_id
+                          AND first.time_left = %%(time)s
+                          AND ids.user_id = first.user_id
+                        RETURNING second.user_id, second.time_left
+                )
+                UPDATE %(table)s AS first
                     SET time_left = second.time_left
-                    FROM "vkontakte_groups_migration_groupmembership_temp" AS second
-                    WHERE first.group_id = %(group)s
-                      AND first.time_left = %(time_left)s
-                      AND first.user_id IN %(members)s
+                    FROM second
+                    WHERE first.group_id = %%(group)s
+                      AND first.time_left = %%(time)s
                       AND first.user_id = second.user_id
-                      AND second.group_id = first.group_id
-                      AND second.time_entered = %(next_time_entered)s;
-
-                DROP TABLE vkontakte_groups_migration_groupmembership_temp;
-                COMMIT;
-                ''', {
-                'group': self.group.pk,
-                'time_left': self.time,
-                'members': tuple(self.next.members_ids),
-                'next_time_entered': self.next.time
-            })
+                ''' % {'table': table}, params)
 
             # все кто вышел сейчас и нет в следующей - вышли в следующей
-            GroupMembership.objects.filter(group=self.group, time_left=self.time).exclude(user_id__in=self.next.members_ids) \
-                .update(time_left=self.next.time)
+            cursor.execute('''
+                UPDATE %s AS m SET time_left = %%(next_time)s
+                    WHERE m.group_id = %%(group)s AND m.time_left = %%(time)s
+                      AND NOT EXISTS (SELECT 1 FROM vkontakte_groups_migration_next_ids AS ids WHERE ids.user_id = m.user_id)
+                ''' % table, params)
 
             # все кто вошел сейчас и нет в следующей - не вошли, удаляем
-            GroupMembership.objects.filter(group=self.group, time_entered=self.time).exclude(user_id__in=self.next.members_ids) \
-                .delete()
+            cursor.execute('''
+                DELETE FROM %s AS m
+                    WHERE m.group_id = %%(group)s AND m.time_entered = %%(time)s
+                      AND NOT EXISTS (SELECT 1 FROM vkontakte_groups_migration_next_ids AS ids WHERE ids.user_id = m.user_id)
+                ''' % table, params)
 
             # все кто вошел сейчас и есть в следующей - вошли в следующей
-            GroupMembership.objects.filter(group=self.group, time_entered=self.time).filter(user_id__in=self.next.members_ids) \
-                .update(time_entered=self.next.time)
+            cursor.execute('''
+                UPDATE %s AS m SET time_entered = %%(next_time)s
+                    FROM vkontakte_groups_migration_next_ids AS ids
+                    WHERE m.group_id = %%(group)s AND m.time_entered = %%(time)s AND ids.user_id = m.user_id
+                ''' % table, params)
+
+            drop_table(cursor, 'vkontakte_groups_migration_next_ids')
 
         else:
             # if no next migration -> delete all current entered users
@@ -324,8 +600,13 @@ class GroupMigration(models.Model):
         Compares ammount of memberships and members_count value and returns True if they are equal or False otherwise
         '''
         difference_count = ''
-        memberships_count = self.user_ids.count()
+        memberships_count, memberships_checksum = GroupMembership.objects.get_checksum(self.group, self.time)
         if memberships_count == self.members_count:
+            if memberships_checksum == self.members_checksum:
+                log.info('%s - %s: %s == %s' % (self.group, self.time, memberships_count, self.members_count))
+                return True
+
+            # checksum of members is unknown for old migrations
             difference_count = len(set(self.user_ids).symmetric_difference(set(self.members_ids)))
             if difference_count == 0:
                 log.info('%s - %s: %s == %s' % (self.group, self.time, memberships_count, self.members_count))
@@ -334,6 +615,7 @@ class GroupMigration(models.Model):
         log.info('%s - %s: %s != %s: %s' % (self.group, self.time, memberships_count, self.members_count, difference_count))
         return False
 
+    @with_timeline
     def update_next(self):
         next_stat = self.next
         if next_stat:
@@ -344,16 +626,36 @@ class GroupMigration(models.Model):
     def save(self, *args, **kwargs):
         try:
             assert self.hidden != self.__class__.objects.light.get(pk=self.pk).hidden
-            update_next = True
         except:
-            update_next = False
+            self.save_migration(*args, **kwargs)
+        else:
+            self.save_visibility(*args, **kwargs)
 
+    def save_migration(self, *args, **kwargs):
         super(GroupMigration, self).save(*args, **kwargs)
 
-        if update_next:
-            self.fix_memberships()
-            self.update_next()
+        if self._timeline is not None and self._timeline.active:
+            self._timeline.update(self)
+
+    @with_timeline
+    def save_visibility(self, *args, **kwargs):
+        '''
+        Save hidden or unhidden migration, fix memberships and the next migration.
+        Members are restored by the chain of visible migrations, so members of this migration and the next one
+        are restored before the chain is changed, hidden migration becomes keyframe
+        '''
+        next_stat = self.next
+        if next_stat and not next_stat.keyframe:
+            next_stat.members_ids
+        if self.hidden and not self.keyframe:
+            self.members_ids
+            self.keyframe = True
+
+        self.save_migration(*args, **kwargs)
+        self.fix_memberships()
+        self.update_next()
 
+    @with_timeline
     def save_final(self):
         '''
         Update local fields, update memberships models and save model,
@@ -371,12 +673,21 @@ class GroupMigration(models.Model):
 
         # call only after saving migrations, because in case of fault we need to
         # have right migrations as source for memberships
+        GroupMembership.objects.create_partition(self.group)
         try:
             self.update_users_memberships()
         except WrongMembershipsAmmount, e:
             log.warning(e)
             GroupMembership.objects.fix_timeline(self.group)
 
+        if SEQUENCE_TIMELINE:
+            GroupSequenceMembership.objects.append(self)
+
+        # members are needed for the next migration of the group
+        if not self.hidden and not self.next:
+            snapshots.put(self.group_id, self.pk, self.members_ids)
+
+    @with_timeline
     def compare_with_siblings(self):
         if self.hidden or not self.prev or self.members_count < 10000:
             return
@@ -409,6 +720,7 @@ class GroupMigration(models.Model):
                         self.members_count, self.prev.members_count, delta, self.next.members_count, delta_next, self.group, self.id))
                     self.prev.hide()
 
+    @with_timeline
     def compare_entered_left(self):
         if self.hidden or not self.prev or self.members_left_count <= 5000 or self.members_entered_count == 0:
             return
@@ -438,25 +750,90 @@ class GroupMigration(models.Model):
 
     def clean_members(self):
         '''
-        Remove double and empty values
+        Remove double values and sort ids
         '''
-        self.members_ids = list(set(self.members_ids))
+        if isinstance(self.members_ids, IdsSpill):
+            spill = self.members_ids
+            self.members_ids = spill.sorted_unique()
+            spill.close()
+        else:
+            self.members_ids = sorted_unique(self.members_ids)
 
+    @with_timeline
     def update(self):
         self.update_entered_left()
+        self.update_keyframe()
 #        self.update_deactivated()
 #        self.update_with_avatar()
         self.update_counters()
 
     def update_entered_left(self):
         prev_stat = self.prev
-        if self.prev and self.group:
-            self.members_left_ids = list(set(prev_stat.members_ids).difference(set(self.members_ids)))
-            self.members_entered_ids = list(set(self.members_ids).difference(set(prev_stat.members_ids)))
+        if prev_stat and self.group:
+            prev_ids = get_members_ids(prev_stat)
+            self.members_left_ids = difference(prev_ids, self.members_ids)
+            self.members_entered_ids = difference(self.members_ids, prev_ids)
         else:
             self.members_left_ids = []
             self.members_entered_ids = []
 
+    def update_keyframe(self):
+        '''
+        Every KEYFRAME_INTERVAL-th visible migration is keyframe, others store only entered and left members
+        '''
+        if not KEYFRAME_INTERVAL or self.hidden or self.time is None:
+            self.keyframe = True
+            return
+
+        distance = 1
+        prev_stat = self.prev
+        while prev_stat and not prev_stat.keyframe:
+            distance += 1
+            prev_stat = prev_stat.prev
+        self.keyframe = not prev_stat or distance >= KEYFRAME_INTERVAL
+
+    def restore_members_ids(self):
+        '''
+        Restore members from the previous keyframe by entered and left members of visible migrations after it.
+        Restoring starts from the latest cached members of the group, if they are in the chain
+        '''
+        chain = [self]
+        migration = self.prev
+        while True:
+            if migration is None:
+                raise MembersNotRestored("Keyframe before migration %s of group %s not found" % (self.pk, self.group_id))
+            members_ids = snapshots.get(migration.group_id, migration.pk)
+            if members_ids is not None and len(members_ids) == migration.members_count:
+                break
+            if migration.keyframe:
+                members_ids = migration.members_ids
+                break
+            chain.append(migration)
+            migration = migration.prev
+
+        for migration in reversed(chain):
+            members_ids = union(difference(members_ids, migration.members_left_ids), migration.members_entered_ids)
+
+        # the chain could be broken by deleting of migrations without model delete()
+        if len(members_ids) != self.members_count \
+                or self.members_checksum is not None and checksum(members_ids) != self.members_checksum:
+            raise MembersNotRestored("Restored members (%d) are not equal to members (%d) of migration %s of group %s" % (
+                len(members_ids), self.members_count, self.pk, self.group_id))
+        return members_ids
+
+    def remember_deleted(self):
+        '''
+        Remember changes of members of visible migration before deleting by queryset or cascade,
+        model delete() hides migration before. Chain of keyframes is repaired after deleting by keep_keyframes_chain
+        '''
+        if self.hidden or self.time is None:
+            return
+
+        if not hasattr(deleted_migrations, 'groups'):
+            deleted_migrations.groups = {}
+        deleted_migrations.groups.setdefault(self.group_id, []).append(
+            (self.pk, self.time, self.members_ids if self.keyframe else None, self.members_entered_ids, self.members_left_ids))
+
     def update_deactivated(self):
         self.members_deactivated_entered_ids = list(
             User.objects.deactivated().filter(remote_id__in=self.members_entered_ids).values_list('remote_id', flat=True))
@@ -472,6 +849,7 @@ class GroupMigration(models.Model):
     def update_counters(self):
         for field_name in ['members', 'members_entered', 'members_left', 'members_deactivated_entered', 'members_deactivated_left', 'members_has_avatar_entered', 'members_has_avatar_left']:
             setattr(self, field_name + '_count', len(getattr(self, field_name + '_ids')))
+        self.members_checksum = checksum(self.members_ids)
 
     @transaction.commit_on_success
     def update_users_memberships(self):
@@ -483,8 +861,7 @@ class GroupMigration(models.Model):
 
         if not self.prev:
             # it's first migration -> create memberships
-            GroupMembership.objects.bulk_create(
-                [GroupMembership(group=self.group, user_id=user_id) for user_id in self.members_ids])
+            bulk_insert(GroupMembership, ['group', 'user_id'], ((self.group.pk, user_id) for user_id in self.members_ids))
         else:
             # ensure current number of memberships equal to members in previous migration
             memberships_count = GroupMembership.objects.get_user_ids(self.group).count()
@@ -494,23 +871,20 @@ class GroupMigration(models.Model):
                 raise WrongMembershipsAmmount("Number of current memberships %d is not equal to members count %d of previous migration, group %s at %s" % (
                     memberships_count, members_count, self.group, self.time))
 
-            # ensure entered users not in memberships now
+            if is_postgresql():
+                self.update_users_memberships_postgresql()
+                return True
+
+            # ensure entered users not in memberships now and left users in memberships now
             error_ids_count = GroupMembership.objects.get_user_ids(
                 self.group).filter(user_id__in=self.members_entered_ids).count()
-            if error_ids_count != 0:
-                raise EnteredMembersAreNotLeft(
-                    "Found %d just entered users, that still not left from the group %s at %s" % (error_ids_count, self.group, self.time))
-
-            # ensure left users in memberships now
             left_ids_count = GroupMembership.objects.get_user_ids(
                 self.group).filter(user_id__in=self.members_left_ids).count()
-            if left_ids_count != self.members_left_count:
-                raise LeftMembersNotInTheGroup("Not all left users found %d != %d between active in group %s at %s" %
-                                (left_ids_count, self.members_left_count, self.group, self.time))
+            self.check_entered_left(error_ids_count, left_ids_count)
 
             # create entered users
-            GroupMembership.objects.bulk_create(
-                [GroupMembership(group=self.group, user_id=user_id, time_entered=self.time) for user_id in self.members_entered_ids])
+            bulk_insert(GroupMembership, ['group', 'user_id', 'time_entered'],
+                        ((self.group.pk, user_id, self.time) for user_id in self.members_entered_ids))
 
             # update left users
             GroupMembership.objects.filter(
@@ -518,64 +892,378 @@ class GroupMigration(models.Model):
 
         return True
 
+    def check_entered_left(self, error_ids_count, left_ids_count):
+        if error_ids_count != 0:
+            raise EnteredMembersAreNotLeft(
+                "Found %d just entered users, that still not left from the group %s at %s" % (error_ids_count, self.group, self.time))
+
+        if left_ids_count != self.members_left_count:
+            raise LeftMembersNotInTheGroup("Not all left users found %d != %d between active in group %s at %s" %
+                                           (left_ids_count, self.members_left_count, self.group, self.time))
+
+    def update_users_memberships_postgresql(self):
+        '''
+        Entered and left ids are loaded to temporary tables once,
+        all checks and updates of memberships are joins with them instead of IN lists
+        '''
+        cursor = connection.cursor()
+        table = quote_name(GroupMembership._meta.db_table)
+        params = {'group': self.group.pk, 'time': self.time}
+
+        create_ids_table(cursor, 'vkontakte_groups_migration_entered_ids', self.members_entered_ids)
+        create_ids_table(cursor, 'vkontakte_groups_migration_left_ids', self.members_left_ids)
+
+        checks = []
+        for ids_table in ['vkontakte_groups_migration_entered_ids', 'vkontakte_groups_migration_left_ids']:
+            cursor.execute('''
+                SELECT count(DISTINCT m.user_id) FROM %s AS m
+                    INNER JOIN %s AS ids ON ids.user_id = m.user_id
+                    WHERE m.group_id = %%(group)s AND m.time_left IS NULL
+                ''' % (table, ids_table), params)
+            checks.append(cursor.fetchone()[0])
+        self.check_entered_left(*checks)
+
+        # create entered users
+        cursor.execute('''
+            INSERT INTO %s (group_id, user_id, time_entered)
+                SELECT %%(group)s, ids.user_id, %%(time)s FROM vkontakte_groups_migration_entered_ids AS ids
+            ''' % table, params)
+
+        # update left users
+        cursor.execute('''
+            UPDATE %s AS m SET time_left = %%(time)s
+                FROM vkontakte_groups_migration_left_ids AS ids
+                WHERE m.group_id = %%(group)s AND m.time_left IS NULL AND m.user_id = ids.user_id
+            ''' % table, params)
+
+        drop_table(cursor, 'vkontakte_groups_migration_entered_ids')
+        drop_table(cursor, 'vkontakte_groups_migration_left_ids')
+
+
+class GroupMigrationCheckpoint(models.Model):
+
+    class Meta:
+        verbose_name = u'Точка сохранения миграции'
+        verbose_name_plural = u'Точки сохранения миграций'
+
+    migration = models.ForeignKey(GroupMigration, related_name='checkpoints')
+    offset = models.PositiveIntegerField()
+    members_ids = IdsField()
+
+
+memberships_constraints = {}
+
+
+def get_memberships_constraints(table):
+    '''
+    Constraints are cached for CONSTRAINTS_TIMEOUT seconds, because they could be changed by migration in other process
+    '''
+    constraints, checked = memberships_constraints.get(table, (None, 0))
+    if constraints is None or time.time() - checked > CONSTRAINTS_TIMEOUT:
+        constraints = {'active_unique': False, 'periods_exclusive': False}
+        if is_postgresql():
+            constraints['active_unique'] = any(['UNIQUE' in index and '(group_id, user_id) WHERE (time_left IS NULL)' in index
+                                                for index in get_indexes(table)])
+            constraints['periods_exclusive'] = has_exclusion_constraint(table)
+        memberships_constraints[table] = (constraints, time.time())
+    return constraints
+
+
+def clear_memberships_constraints():
+    memberships_constraints.clear()
+
 
 class GroupMembershipManager(models.Manager):
 
     def fix_timeline(self, group):
         '''
         In consistent case it just check_memberships_count of last migr and exit
-        In incosistent case it will go back to previous migration that is consistent, and start to update memberships further
+        In incosistent case it will find the last consistent migration by bisection, and update memberships further once
         '''
+        # neighbours of migrations are taken from the timeline loaded once
+        timeline = MigrationTimeline(group)
+        try:
+            migrations = list(timeline)
+            if not migrations or migrations[-1].check_memberships_count():
+                return
+
+            migr = self.get_consistent_migration(migrations[:-1])
+            if not migr:
+                # there is nothing to keep, so memberships are made from scratch without saving of migrations
+                self.rebuild_timeline(group)
+                return
+            self.clear_timeline_after_migration(group, migr)
+
+            bound = len(migrations)
+            while True:
+                migr = migr.next if migr else (timeline.migrations[0] if len(timeline) else None)
+                if not migr:
+                    break
+                try:
+                    migr.save_final()
+                except (EnteredMembersAreNotLeft, LeftMembersNotInTheGroup), e:
+                    # memberships of the previous migration are broken, search the consistent one before it
+                    bound = min(bound, timeline.migrations.index(migr)) - 1
+                    if bound < 0:
+                        raise
+                    log.warning(e)
+                    migr = self.get_consistent_migration(timeline.migrations[:bound])
+                    self.clear_timeline_after_migration(group, migr)
+        finally:
+            timeline.active = False
+
         migr = group.migrations.latest('id')
+        log.info('%s: %s == %s' % (group, self.get_user_ids(group).count(), migr.members_count))
 
-        while True:
-            if not migr or migr.check_memberships_count():
-                break
+    def get_consistent_migration(self, migrations):
+        '''
+        Returns the last migration from the list ordered by time with consistent memberships or None.
+        Memberships are broken since some migration and all later ones are inconsistent too,
+        so it's found by bisection with O(log n) checks of memberships
+        '''
+        low, high = 0, len(migrations)
+        while low < high:
+            middle = (low + high) // 2
+            if migrations[middle].check_memberships_count():
+                low = middle + 1
             else:
-                migr = migr.prev
+                high = middle
+        return migrations[low - 1] if low else None
 
-        self.clear_timeline_after_migration(group, migr)
+    def rebuild_timeline(self, group):
+        '''
+        Make all memberships of the group from scratch by its visible migrations in one transaction.
+        Migrations are loaded one by one in time order, periods of memberships are calculated by operations
+        with arrays of ids and loaded by COPY for every migration instead of saving of migrations by save_final
+        '''
+        self.create_partition(group)
+        self._rebuild_timeline(group)
 
-        while True:
-            try:
-                migr = migr.next if migr else group.migrations.order_by('time')[0]
-                migr.save_final()
-                migr.check_memberships_count()
-            except (EnteredMembersAreNotLeft, LeftMembersNotInTheGroup):
-                # go back and clear one more
-                migr = migr.prev.prev.prev
-                self.clear_timeline_after_migration(group, migr)
-            except AttributeError:
-                break
+    @transaction.commit_on_success
+    def _rebuild_timeline(self, group):
+        migrations = list(group.migrations.visible.order_by('time').values_list('pk', 'time'))
+        # members of the first migration have no time of entering
+        times = [None] + [time for pk, time in migrations[1:]]
+
+        def load_members():
+            for pk, time in migrations:
+                migration = GroupMigration.objects.light.get(pk=pk)
+                members_ids = get_members_ids(migration)
+                # the next migration is restored from these members, if it's not keyframe
+                snapshots.put(group.pk, pk, members_ids)
+                yield members_ids
+
+        if not truncate_partition(connection.cursor(), self.model._meta.db_table, group.pk):
+            self.filter(group=group).delete()
 
-        migr = group.migrations.latest('id')
-        log.info('%s: %s == %s' % (group, self.get_user_ids(group).count(), migr.members_count))
+        # snapshots are loaded between COPY statements, connection couldn't run queries while copying
+        for user_ids, entered, left in periods(load_members()):
+            time_left = times[left] if left is not None else None
+            bulk_insert(self.model, ['group', 'user_id', 'time_entered', 'time_left'],
+                        ((group.pk, user_id, times[index], time_left) for user_id, index in izip(user_ids, entered)))
+
+        log.info('%s: memberships rebuilt by %d migrations' % (group, len(migrations)))
 
+    @transaction.commit_on_success
+    def append_migrations(self, group, migrations, prev=None):
+        '''
+        Write memberships of visible migrations following `prev` migration at once.
+        Periods of memberships are calculated in memory, all memberships are inserted by one COPY
+        and memberships of `prev`, that are closed by migrations, are updated by one query.
+        Partition of the group should be created before
+        '''
+        if prev:
+            # ensure current memberships are equal to members in previous migration
+            memberships_count, memberships_checksum = self.get_checksum(group)
+            if memberships_count != prev.members_count \
+                    or prev.members_checksum is not None and memberships_checksum != prev.members_checksum:
+                raise WrongMembershipsAmmount("Current memberships (%d) are not equal to members (%d) of previous migration, group %s at %s" % (
+                    memberships_count, prev.members_count, group, migrations[0].time))
+            migrations = [prev] + list(migrations)
+        elif self.filter(group=group).exists():
+            # the previous migration could be hidden after its memberships are written
+            raise WrongMembershipsAmmount("Memberships exist before the first migration, group %s at %s" % (
+                group, migrations[0].time))
+
+        times = [migration.time for migration in migrations]
+        if not prev:
+            # members of the first migration of the group have no time of entering
+            times[0] = None
+
+        memberships = []
+        left_memberships = []
+        for user_ids, entered, left in periods([migration.members_ids for migration in migrations]):
+            time_left = times[left] if left is not None else None
+            for user_id, index in izip(user_ids, entered):
+                if prev and index == 0:
+                    # membership of the previous migration
+                    if time_left:
+                        left_memberships += [(user_id, time_left)]
+                else:
+                    memberships += [(group.pk, user_id, times[index], time_left)]
+
+        # memberships are closed before inserting, because user could enter again
+        if is_postgresql():
+            cursor = connection.cursor()
+            drop_table(cursor, 'vkontakte_groups_migration_left_times')
+            cursor.execute('CREATE TEMP TABLE vkontakte_groups_migration_left_times '
+                           '(user_id integer PRIMARY KEY, time_left timestamp with time zone)')
+            copy_rows(cursor, 'vkontakte_groups_migration_left_times', ['user_id', 'time_left'],
+                      prepare_rows([self.model._meta.get_field('user_id'), self.model._meta.get_field('time_left')],
+                                   left_memberships))
+            cursor.execute('''
+                UPDATE %s AS m SET time_left = ids.time_left
+                    FROM vkontakte_groups_migration_left_times AS ids
+                    WHERE m.group_id = %%s AND m.time_left IS NULL AND m.user_id = ids.user_id
+                ''' % quote_name(self.model._meta.db_table), [group.pk])
+            drop_table(cursor, 'vkontakte_groups_migration_left_times')
+        else:
+            for time_left in set([time for user_id, time in left_memberships]):
+                self.filter(group=group, time_left=None,
+                            user_id__in=[user_id for user_id, time in left_memberships if time == time_left]) \
+                    .update(time_left=time_left)
+
+        bulk_insert(self.model, ['group', 'user_id', 'time_entered', 'time_left'], memberships)
+
+    @transaction.commit_on_success
     def clear_timeline_after_migration(self, group, migr):
+        '''
+        If memberships of the group are in own partition, it's truncated instead of deleting of rows
+        '''
         if migr:
             self.clear_timeline_after(group, migr.time)
-        else:
+        elif not truncate_partition(connection.cursor(), self.model._meta.db_table, group.pk):
             self.filter(group=group).delete()
 
+    @transaction.commit_on_success
     def clear_timeline_after(self, group, time):
         '''
         Method:
          * removes all entered and left users after `time`
          * removes all entered and not left after `time`
          * makes all left users after `time` not left
+        If memberships of the group are in own partition, it's rebuilt from the rest of memberships
         '''
+        table = self.model._meta.db_table
+        params = {'group': group.pk, 'time': self.model._meta.get_field('time_left').get_db_prep_value(time, connection)}
+        if replace_partition(connection.cursor(), table, group.pk,
+                             ['id', 'group_id', 'user_id', 'time_entered', 'time_left'], '''
+                SELECT id, group_id, user_id, time_entered, CASE WHEN time_left > %%(time)s THEN NULL ELSE time_left END
+                    FROM %s
+                    WHERE group_id = %%(group)s AND (time_entered IS NULL OR time_entered <= %%(time)s)
+                ''' % quote_name(table), params):
+            return
+
         self.filter(group=group, time_left__gt=time, time_entered__gt=time).delete()
         self.filter(group=group, time_entered__gt=time, time_left=None).delete()
         self.filter(group=group, time_left__gt=time).update(time_left=None)
 
-    def _prepare_qs(self, qs, unique):
+    def create_partition(self, group):
+        '''
+        Create partition for memberships of the group, if table is partitioned by list of groups.
+        Creating of partition locks the whole table, so it's committed in own transaction before writing of memberships
+        '''
+        cursor = connection.cursor()
+        table = self.model._meta.db_table
+        strategy, partitions = get_cached_partitions(cursor, table)
+        if strategy != 'list' or get_partition_name(table, group.pk) in partitions:
+            return
+
+        with transaction.commit_on_success():
+            # partition could be created by other process
+            partitions.update(get_partitions(cursor, table))
+            create_partition(cursor, table, group.pk, partitions)
+
+    @transaction.commit_on_success
+    def repair(self, group=None):
+        '''
+        Merge duplicated and overlapping memberships of the same user into one membership,
+        that is necessary before creating of constraints. Returns number of removed memberships
+        '''
+        if not is_postgresql():
+            raise NotImplementedError("Repairing of memberships requires PostgreSQL, database backend is %s"
+                                      % connection.vendor)
+
+        cursor = connection.cursor()
+        table = quote_name(self.model._meta.db_table)
+        where = 'WHERE group_id = %s' % int(group.pk) if group else ''
+
+        # memberships, that start before the end of any previous membership of the user, are in the same island
+        drop_table(cursor, 'vkontakte_groups_migration_islands')
+        cursor.execute('''
+            CREATE TEMP TABLE vkontakte_groups_migration_islands AS
+                SELECT id, group_id, user_id, time_entered, time_left,
+                       sum(CASE WHEN prev_end IS NULL OR start >= prev_end THEN 1 ELSE 0 END)
+                           OVER (PARTITION BY group_id, user_id ORDER BY start, id) AS island
+                FROM (
+                    SELECT *, COALESCE(time_entered, '-infinity'::timestamptz) AS start,
+                           max(COALESCE(time_left, 'infinity'::timestamptz)) OVER (PARTITION BY group_id, user_id
+                               ORDER BY COALESCE(time_entered, '-infinity'::timestamptz), id
+                               ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS prev_end
+                    FROM %s %s
+                ) AS memberships
+            ''' % (table, where))
+
+        drop_table(cursor, 'vkontakte_groups_migration_merged')
+        cursor.execute('''
+            CREATE TEMP TABLE vkontakte_groups_migration_merged AS
+                SELECT group_id, user_id, island, min(id) AS id,
+                       CASE WHEN bool_or(time_entered IS NULL) THEN NULL ELSE min(time_entered) END AS time_entered,
+                       CASE WHEN bool_or(time_left IS NULL) THEN NULL ELSE max(time_left) END AS time_left
+                FROM vkontakte_groups_migration_islands
+                GROUP BY group_id, user_id, island
+                HAVING count(*) > 1
+            ''')
+
+        cursor.execute('''
+            DELETE FROM %s AS m
+                USING vkontakte_groups_migration_islands AS i, vkontakte_groups_migration_merged AS merged
+                WHERE m.id = i.id AND merged.group_id = i.group_id AND merged.user_id = i.user_id
+                  AND merged.island = i.island AND merged.id <> i.id
+            ''' % table)
+        count = cursor.rowcount
+
+        cursor.execute('''
+            UPDATE %s AS m SET time_entered = merged.time_entered, time_left = merged.time_left
+                FROM vkontakte_groups_migration_merged AS merged
+                WHERE m.id = merged.id
+            ''' % table)
+
+        drop_table(cursor, 'vkontakte_groups_migration_islands')
+        drop_table(cursor, 'vkontakte_groups_migration_merged')
+        return count
+
+    @property
+    def constraints(self):
+        '''
+        Guarantees of uniqueness of memberships given by constraints of DB, checked again after timeout or migration:
+         * active_unique - only one active membership of user in the group
+         * periods_exclusive - periods of memberships of user in the group don't overlap
+        '''
+        return get_memberships_constraints(self.model._meta.db_table)
+
+    def _prepare_qs(self, qs, unique, distinct=True):
+        '''
+        If `distinct` is False, DB guarantees unique ids and DISTINCT is not necessary
+        '''
         if unique:
-            qs = qs.order_by('user_id').distinct('user_id')
+            qs = qs.order_by('user_id')
+            if distinct:
+                qs = qs.distinct('user_id')
         return qs.values_list('user_id', flat=True)
 
     def get_user_ids(self, group, time=None, unique=True):
         if time is None:
             qs = self.filter(group=group, time_left=None)
+            return self._prepare_qs(qs, unique, distinct=not self.constraints['active_unique'])
+        elif is_postgresql():
+            # membership period [time_entered, time_left) with open bounds contains time,
+            # expressions are the same as in index of periods
+            time = self.model._meta.get_field('time_left').get_db_prep_value(time, connection)
+            qs = self.filter(group=group).extra(where=[
+                "COALESCE(time_left, 'infinity'::timestamptz) > %s",
+                "COALESCE(time_entered, '-infinity'::timestamptz) <= %s",
+            ], params=[time, time])
         else:
             qs = self.filter(group=group) \
                 .filter(Q(time_entered=None,        time_left=None) |
@@ -583,15 +1271,28 @@ class GroupMembershipManager(models.Manager):
                         Q(time_entered__lte=time,   time_left=None) |
                         Q(time_entered__lte=time,   time_left__gt=time))
 
-        return self._prepare_qs(qs, unique)
+        return self._prepare_qs(qs, unique, distinct=not self.constraints['periods_exclusive'])
+
+    def get_checksum(self, group, time=None):
+        '''
+        Returns number of members of the group at `time` and checksum of their ids by one aggregate query
+        '''
+        sql, params = self.get_user_ids(group, time).query.sql_with_params()
+        # integer of postgres is 32-bit, other backends calculate in 64-bit integers
+        user_id = 'CAST(user_id AS bigint)' if is_postgresql() else 'user_id'
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*), sum((%s * %d) %%%% %d) FROM (%s) AS ids' % (
+            user_id, CHECKSUM_MULTIPLIER, CHECKSUM_MODULUS, sql), params)
+        count, value = cursor.fetchone()
+        return count, int(value or 0)
 
     def get_entered_user_ids(self, group, time, unique=True):
         qs = self.filter(group=group).filter(time_entered=time)
-        return self._prepare_qs(qs, unique)
+        return self._prepare_qs(qs, unique, distinct=not self.constraints['periods_exclusive'])
 
     def get_left_user_ids(self, group, time, unique=True):
         qs = self.filter(group=group).filter(time_left=time)
-        return self._prepare_qs(qs, unique)
+        return self._prepare_qs(qs, unique, distinct=not self.constraints['periods_exclusive'])
 
     def get_user_ids_of_period(self, group, date_from, date_to, field=None, unique=True):
 
@@ -640,4 +1341,128 @@ class GroupMembership(models.Model):
 
         return super(GroupMembership, self).save(*args, **kwargs)
 
+class GroupSequenceMembershipManager(models.Manager):
+    '''
+    Experimental timeline of memberships, where periods are bounded by sequence numbers of migrations instead of their time.
+    Every finalized migration is appended to the timeline including hidden ones, and hidden migrations are
+    skipped only while querying, so hiding or deleting of migration doesn't change these memberships.
+    It's kept only if SEQUENCE_TIMELINE setting is on, in addition to GroupMembership,
+    which is still the main timeline used by all queries and fixed after hiding of migration
+    '''
+
+    def get_sequence(self, migration):
+        if migration.sequence is None:
+            raise ValueError("Migration %s of group %s is not in the sequence timeline, rebuild it" % (migration.pk, migration.group))
+        return migration.sequence
+
+    @transaction.commit_on_success
+    def append(self, migration, last=None):
+        '''
+        Append migration to the end of sequence timeline of the group.
+        If `last` is not given, it's the last appended migration of the group
+        '''
+        if migration.sequence is not None or migration.time is None:
+            return
+
+        if last is None:
+            try:
+                last = migration.group.migrations.exclude(sequence=None).order_by('-sequence')[0]
+            except IndexError:
+                pass
+
+        if last and last.time > migration.time:
+            log.warning("Migration %s is older than the last migration in the sequence timeline of group %s, rebuild it" % (
+                migration.pk, migration.group))
+            return
+
+        migration.sequence = last.sequence + 1 if last else 1
+        GroupMigration.objects.filter(pk=migration.pk).update(sequence=migration.sequence)
+
+        if last:
+            entered_ids = difference(migration.members_ids, last.members_ids)
+            left_ids = difference(last.members_ids, migration.members_ids)
+        else:
+            entered_ids = migration.members_ids
+            left_ids = []
+
+        bulk_insert(self.model, ['group', 'user_id', 'sequence_entered'],
+                    ((migration.group.pk, user_id, migration.sequence) for user_id in entered_ids))
+
+        if is_postgresql():
+            cursor = connection.cursor()
+            create_ids_table(cursor, 'vkontakte_groups_migration_left_ids', left_ids)
+            cursor.execute('''
+                UPDATE %s AS m SET sequence_left = %%(sequence)s
+                    FROM vkontakte_groups_migration_left_ids AS ids
+                    WHERE m.group_id = %%(group)s AND m.sequence_left IS NULL AND m.user_id = ids.user_id
+                ''' % quote_name(self.model._meta.db_table), {'group': migration.group.pk, 'sequence': migration.sequence})
+            drop_table(cursor, 'vkontakte_groups_migration_left_ids')
+        else:
+            self.filter(group=migration.group, sequence_left=None, user_id__in=left_ids) \
+                .update(sequence_left=migration.sequence)
+
+    @transaction.commit_on_success
+    def rebuild(self, group):
+        '''
+        Renumber all finalized migrations of the group and make sequence timeline from scratch
+        '''
+        self.filter(group=group).delete()
+        group.migrations.update(sequence=None)
+
+        last = None
+        for migration in group.migrations.exclude(time=None).order_by('time'):
+            self.append(migration, last)
+            last = migration
+
+    def _prepare_qs(self, qs, unique):
+        '''
+        Periods of memberships of user never overlap, so DISTINCT is not necessary
+        '''
+        if unique:
+            qs = qs.order_by('user_id')
+        return qs.values_list('user_id', flat=True)
+
+    def get_user_ids(self, migration, unique=True):
+        sequence = self.get_sequence(migration)
+        qs = self.filter(group=migration.group, sequence_entered__lte=sequence) \
+            .filter(Q(sequence_left=None) | Q(sequence_left__gt=sequence))
+        return self._prepare_qs(qs, unique)
+
+    def get_entered_user_ids(self, migration, unique=True):
+        '''
+        Users, that are members of migration and weren't members of the previous visible migration
+        '''
+        prev = migration.prev
+        if not prev:
+            return self.none().values_list('user_id', flat=True)
+        return self.get_user_ids(migration, unique) \
+            .filter(sequence_entered__gt=self.get_sequence(prev)) \
+            .exclude(user_id__in=self.get_user_ids(prev, unique=False))
+
+    def get_left_user_ids(self, migration, unique=True):
+        '''
+        Users, that were members of the previous visible migration and aren't members of migration
+        '''
+        prev = migration.prev
+        if not prev:
+            return self.none().values_list('user_id', flat=True)
+        return self.get_user_ids(prev, unique) \
+            .filter(sequence_left__lte=self.get_sequence(migration)) \
+            .exclude(user_id__in=self.get_user_ids(migration, unique=False))
+
+
+class GroupSequenceMembership(models.Model):
+
+    class Meta:
+        verbose_name = u'Членство пользователя по номерам миграций'
+        verbose_name_plural = u'Членства пользователей по номерам миграций'
+
+    group = models.ForeignKey(Group, verbose_name=u'Группа', related_name='sequence_memberships')
+    user_id = models.PositiveIntegerField(u'ID пользователя', db_index=True)
+
+    sequence_entered = models.PositiveIntegerField(u'Номер миграции вступления')
+    sequence_left = models.PositiveIntegerField(u'Номер миграции выхода', null=True)
+
+    objects = GroupSequenceMembershipManager()
+
 from . import signals
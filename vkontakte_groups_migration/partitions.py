@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+'''
+Declarative partitioning of PostgreSQL tables by `group_id` (PostgreSQL 11+).
+
+With list partitioning every group has own partition, that is created before the first
+memberships of the group are inserted. All memberships of the group could be truncated,
+or the partition could be rebuilt from the selected rows and swapped with the old one,
+so there are no mass deletes and vacuum of the whole table.
+Hash partitioning spreads groups between fixed number of partitions.
+'''
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.db.utils import DatabaseError
+
+from .db import drop_table, is_postgresql, quote_name
+
+log = logging.getLogger('vkontakte_groups_migration')
+
+PARTITIONING = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_PARTITIONING', None)
+HASH_PARTITIONS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_HASH_PARTITIONS', 16)
+
+STRATEGIES = {
+    'l': 'list',
+    'h': 'hash',
+}
+
+# strategies of partitioning of tables and their partitions with bounds, known by the process
+cache = {}
+
+
+def is_supported():
+    if not is_postgresql():
+        return False
+    connection.cursor()
+    return connection.pg_version >= 110000
+
+
+def check_deferred_constraints(cursor):
+    '''
+    Check deferred constraints of rows, inserted in the current transaction.
+    Tables with pending checks couldn't be altered or truncated
+    '''
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+def get_partitioning(cursor, table):
+    '''
+    Returns strategy of partitioning of the table: 'list', 'hash' or None
+    '''
+    if not is_supported():
+        return None
+    cursor.execute('SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table])
+    row = cursor.fetchone()
+    return STRATEGIES.get(row[0]) if row else None
+
+
+def get_partitions(cursor, table):
+    '''
+    Returns dict with names of partitions of the table and their bounds
+    '''
+    cursor.execute('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits AS i
+            INNER JOIN pg_class AS c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        ''', [table])
+    return dict(cursor.fetchall())
+
+
+def get_cached_partitions(cursor, table):
+    '''
+    Returns strategy of partitioning of the table and dict with its partitions, they are read once by the process.
+    Partitioning is changed only by partition_memberships command, so workers should be restarted after it
+    '''
+    if table not in cache:
+        strategy = get_partitioning(cursor, table)
+        cache[table] = (strategy, get_partitions(cursor, table) if strategy else {})
+    return cache[table]
+
+
+def clear_cache():
+    cache.clear()
+
+
+def get_partition_name(table, group_id):
+    return '%s_%d' % (table, group_id)
+
+
+def get_group_partition(cursor, table, group_id):
+    '''
+    Returns name of the list partition of the group or None
+    '''
+    if get_partitioning(cursor, table) != 'list':
+        return None
+    partition = get_partition_name(table, group_id)
+    return partition if partition in get_partitions(cursor, table) else None
+
+
+def create_partition(cursor, table, group_id, partitions=None):
+    '''
+    Create list partition of the group, if it doesn't exist.
+    Rows of the group are moved from the default partition to the new one.
+    `partitions` are existing partitions of the table, they are read if not given and the new one is added to them
+    '''
+    partitions = get_partitions(cursor, table) if partitions is None else partitions
+    partition = get_partition_name(table, group_id)
+    if partition in partitions:
+        return partition
+
+    default = ([name for name, bound in partitions.items() if bound == 'DEFAULT'] or [None])[0]
+    if default:
+        cursor.execute('SELECT count(*) FROM (SELECT 1 FROM %s WHERE group_id = %%s LIMIT 1) AS rows' % quote_name(default),
+                       [group_id])
+        default = default if cursor.fetchone()[0] else None
+
+    if default:
+        check_deferred_constraints(cursor)
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (quote_name(partition), quote_name(table)))
+        cursor.execute('INSERT INTO %s SELECT * FROM %s WHERE group_id = %%s' % (quote_name(partition), quote_name(default)),
+                       [group_id])
+        cursor.execute('DELETE FROM %s WHERE group_id = %%s' % quote_name(default), [group_id])
+        cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%d)' % (quote_name(table), quote_name(partition),
+                                                                                   group_id))
+    else:
+        cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%d)' % (quote_name(partition), quote_name(table),
+                                                                               group_id))
+    partitions[partition] = 'FOR VALUES IN (%d)' % group_id
+    return partition
+
+
+def truncate_partition(cursor, table, group_id):
+    '''
+    Truncate list partition of the group. Returns False if there is no partition of the group
+    '''
+    partition = get_group_partition(cursor, table, group_id)
+    if not partition:
+        return False
+    check_deferred_constraints(cursor)
+    cursor.execute('TRUNCATE %s' % quote_name(partition))
+    return True
+
+
+def replace_partition(cursor, table, group_id, columns, select, params=None):
+    '''
+    Rebuild list partition of the group from `columns` of rows of `select` query (it could select from the table)
+    and swap the new partition with the old one. Returns False if there is no partition of the group
+    '''
+    partition = get_group_partition(cursor, table, group_id)
+    if not partition:
+        return False
+
+    new = '%s_new' % partition
+    check = '%s_group_check' % partition
+    check_deferred_constraints(cursor)
+    drop_table(cursor, quote_name(new))
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (quote_name(new), quote_name(table)))
+    # with this constraint the new partition is attached without scanning
+    cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s CHECK (group_id = %d)' % (quote_name(new), quote_name(check), group_id))
+    cursor.execute('INSERT INTO %s (%s) %s' % (quote_name(new), ', '.join(columns), select), params)
+
+    cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (quote_name(table), quote_name(partition)))
+    drop_table(cursor, quote_name(partition))
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (quote_name(new), quote_name(partition)))
+    cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%d)' % (quote_name(table), quote_name(partition),
+                                                                               group_id))
+    cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (quote_name(partition), quote_name(check)))
+    return True
+
+
+def _recreate_table(cursor, table, partition_by=None, create_partitions=None):
+    '''
+    Copy the table to the new one with the same indexes and constraints.
+    If `partition_by` is given, the new table is partitioned and its primary key includes `group_id`
+    '''
+    old = '%s_old' % table
+    cursor.execute('''
+        SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = %s AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s))
+        ''', [table, table])
+    indexes = cursor.fetchall()
+    cursor.execute('''
+        SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u', 'f', 'x')
+        ''', [table])
+    constraints = cursor.fetchall()
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    sequence = cursor.fetchone()[0]
+
+    check_deferred_constraints(cursor)
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (quote_name(table), quote_name(old)))
+    # names of indexes and constraints should be free for the new table
+    for name, type, definition in constraints:
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (quote_name(old), quote_name(name)))
+    for name, definition in indexes:
+        cursor.execute('DROP INDEX %s' % quote_name(name))
+
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) %s' % (quote_name(table), quote_name(old),
+                                                                     'PARTITION BY %s' % partition_by if partition_by else ''))
+    if create_partitions:
+        create_partitions(old)
+    cursor.execute('INSERT INTO %s SELECT * FROM %s' % (quote_name(table), quote_name(old)))
+
+    # indexes are created after copying of rows, they are propagated to partitions
+    for name, type, definition in constraints:
+        if type == 'p':
+            definition = 'PRIMARY KEY (id, group_id)' if partition_by else 'PRIMARY KEY (id)'
+        elif type != 'x':
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (quote_name(table), quote_name(name), definition))
+            continue
+        cursor.execute('SAVEPOINT vkontakte_groups_migration_constraint')
+        try:
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (quote_name(table), quote_name(name), definition))
+        except DatabaseError, e:
+            # exclusion constraints are not supported by partitioned tables before PostgreSQL 17
+            cursor.execute('ROLLBACK TO SAVEPOINT vkontakte_groups_migration_constraint')
+            log.warning('Constraint %s of table %s was not created: %s' % (name, table, e))
+        else:
+            cursor.execute('RELEASE SAVEPOINT vkontakte_groups_migration_constraint')
+    for name, definition in indexes:
+        cursor.execute(definition)
+
+    if sequence:
+        cursor.execute('ALTER SEQUENCE %s OWNED BY %s.id' % (sequence, quote_name(table)))
+    cursor.execute('DROP TABLE %s CASCADE' % quote_name(old))
+
+
+def partition_table(cursor, table, strategy=None, partitions=None):
+    '''
+    Convert the table to the table partitioned by `group_id`.
+    List partitions are created for all groups in the table, new groups get partitions while inserting.
+    Hash partitions are created according to `partitions` argument or HASH_PARTITIONS setting
+    '''
+    strategy = strategy or PARTITIONING
+    partitions = partitions or HASH_PARTITIONS
+    if strategy not in STRATEGIES.values():
+        raise ValueError("Strategy of partitioning should be one of %s" % STRATEGIES.values())
+    if not is_supported():
+        raise NotImplementedError("Partitioning is implemented only for PostgreSQL 11 and later")
+    if get_partitioning(cursor, table):
+        return
+    clear_cache()
+
+    def create_partitions(old):
+        if strategy == 'list':
+            cursor.execute('SELECT DISTINCT group_id FROM %s' % quote_name(old))
+            for group_id, in cursor.fetchall():
+                create_partition(cursor, table, group_id)
+            cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (quote_name('%s_default' % table), quote_name(table)))
+        else:
+            for remainder in range(partitions):
+                cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES WITH (MODULUS %d, REMAINDER %d)' % (
+                    quote_name('%s_p%d' % (table, remainder)), quote_name(table), partitions, remainder))
+
+    _recreate_table(cursor, table, 'LIST (group_id)' if strategy == 'list' else 'HASH (group_id)', create_partitions)
+
+
+def unpartition_table(cursor, table):
+    '''
+    Convert partitioned table back to the ordinary table
+    '''
+    if get_partitioning(cursor, table):
+        clear_cache()
+        _recreate_table(cursor, table)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from Queue import Queue, Empty
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from vkontakte_api.decorators import opt_generator
+
+from .fetchers import RateLimiter, REQUESTS_PER_SECOND, get_members_fetcher
+from .models import GroupMigration
+from .tokens import get_token_pool
+
+log = logging.getLogger('vkontakte_groups_migration')
+
+WORKERS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_WORKERS', 4)
+
+
+class CrawlStats(object):
+    '''
+    Aggregate throughput of the crawling of groups
+    '''
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.started = time.time()
+        self.pages = 0
+        self.finished = []
+        self.failed = []
+
+    @property
+    def seconds(self):
+        return time.time() - self.started
+
+    @property
+    def requests(self):
+        return self.limiter.calls
+
+    @property
+    def requests_per_second(self):
+        return self.requests / self.seconds
+
+    @property
+    def pages_per_second(self):
+        return self.pages / self.seconds
+
+    def __str__(self):
+        return '%d groups finished, %d failed, %d pages, %d requests in %.1f seconds (%.2f requests/s, %.2f pages/s)' % (
+            len(self.finished), len(self.failed), self.pages, self.requests, self.seconds,
+            self.requests_per_second, self.pages_per_second)
+
+
+class CrawlScheduler(object):
+    '''
+    Crawler of members of several groups. Groups are crawled by the pool of workers,
+    all page requests share one limiter with requests per second budget of the access token,
+    so requests of different groups are interleaved evenly without bursts.
+    In token pool mode every token of the pool has own budget, `rate` limits all requests if it's given.
+    Keyword arguments are passed to `get_members_fetcher` for every group
+    '''
+
+    def __init__(self, groups, workers=None, rate=None, pool=None, **kwargs):
+        self.groups = list(groups)
+        self.workers = workers or WORKERS
+        if pool is None:
+            pool = get_token_pool(kwargs.pop('http_client', None))
+        self.limiter = RateLimiter(rate or (None if pool else REQUESTS_PER_SECOND))
+        self.kwargs = dict(kwargs, pool=pool)
+        self.stats = CrawlStats(self.limiter)
+
+    def make_fetcher(self, group):
+        return get_members_fetcher(group, limiter=self.limiter, **self.kwargs)
+
+    def crawl_group(self, group, events):
+        try:
+            fetcher = self.make_fetcher(group)
+            for offset, count, step in GroupMigration.objects.update_for_group(group, fetcher=fetcher, as_generator=True):
+                events.put((group, offset, count))
+            self.stats.finished.append(group)
+        except Exception, e:
+            log.exception('Crawling of members of the group "%s" failed: %s' % (group, e))
+            self.stats.failed.append(group)
+
+    def work(self, groups, events):
+        try:
+            while True:
+                try:
+                    group = groups.get_nowait()
+                except Empty:
+                    break
+                self.crawl_group(group, events)
+        finally:
+            # every worker uses own connection to DB
+            connection.close()
+            events.put(None)
+
+    @opt_generator
+    def run(self):
+        '''
+        Crawl all groups, yields tuples (group, offset, count, stats) after every fetched page
+        '''
+        groups = Queue()
+        for group in self.groups:
+            groups.put(group)
+
+        events = Queue()
+        workers = [threading.Thread(target=self.work, args=(groups, events))
+                   for i in range(min(self.workers, len(self.groups)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        running = len(workers)
+        while running:
+            event = events.get()
+            if event is None:
+                running -= 1
+                continue
+            self.stats.pages += 1
+            group, offset, count = event
+            yield group, offset, count, self.stats
+
+        log.info('Crawling of members of %d groups finished: %s' % (len(self.groups), self.stats))
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from annoying.decorators import signals
 from django.conf import settings
+from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import Signal
 
-from .models import GroupMigration, update_group_users
+from . import partitions
+from .models import GroupMigration, clear_memberships_constraints, update_group_users
 
 group_migration_updated = Signal(providing_args=['instance'])
 group_users_updated = Signal(providing_args=['instance'])
@@ -16,3 +18,24 @@ def group_users_update_m2m(sender, instance, **kwargs):
         return VkontakteGroupUpdateUsersM2M.delay(instance.id)
     else:
         update_group_users(instance.group)
+
+
+@signals(pre_delete, sender=GroupMigration)
+def group_migration_remember_deleted(sender, instance, **kwargs):
+    instance.remember_deleted()
+
+
+@signals(post_delete, sender=GroupMigration)
+def group_migration_keep_keyframes_chain(sender, instance, **kwargs):
+    GroupMigration.objects.keep_keyframes_chain(instance.group_id)
+
+
+if 'south' in settings.INSTALLED_APPS:
+    from south.signals import post_migrate
+
+    @signals(post_migrate)
+    def memberships_constraints_clear(sender, app, **kwargs):
+        # migration could create or drop constraints and partitions of memberships
+        if app == 'vkontakte_groups_migration':
+            clear_memberships_constraints()
+            partitions.clear_cache()
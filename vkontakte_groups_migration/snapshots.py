@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''
+Process-level cache of decoded members of the latest visible migration of every group.
+
+Members of finalized migration never change, so the cached array is valid while it's kept by id of migration,
+entry of the group is dropped when the latest migration is hidden or memberships are fixed.
+Groups are evicted in LRU order, when size of cached arrays exceeds memory budget.
+'''
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+SNAPSHOT_CACHE_SIZE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_SNAPSHOT_CACHE_SIZE', 100 * 2 ** 20)
+
+
+def get_size(ids):
+    return len(ids) * getattr(ids, 'itemsize', 4)
+
+
+class SnapshotCache(object):
+
+    def __init__(self, size=None):
+        self.size = SNAPSHOT_CACHE_SIZE if size is None else size
+        self.used = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, group_id, migration_id):
+        '''
+        Returns members of the migration or None if they are not cached
+        '''
+        with self.lock:
+            entry = self.entries.pop(group_id, None)
+            if entry is None:
+                return None
+            # the entry becomes the most recently used
+            self.entries[group_id] = entry
+            return entry[1] if entry[0] == migration_id else None
+
+    def put(self, group_id, migration_id, ids):
+        '''
+        Cache members of the migration as the latest one of the group instead of previous entry of the group
+        '''
+        size = get_size(ids)
+        with self.lock:
+            self._remove(group_id)
+            if size > self.size:
+                return
+            while self.used + size > self.size:
+                self._remove(next(iter(self.entries)))
+            self.entries[group_id] = (migration_id, ids, size)
+            self.used += size
+
+    def invalidate(self, group_id):
+        with self.lock:
+            self._remove(group_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def _remove(self, group_id):
+        entry = self.entries.pop(group_id, None)
+        if entry is not None:
+            self.used -= entry[2]
+
+
+snapshots = SnapshotCache()
+
+
+def get_members_ids(migration):
+    '''
+    Returns members of migration from the cache, if they are not loaded yet, otherwise loads and caches them.
+    Only members of finalized migrations should be taken by this way
+    '''
+    if 'members_ids' in migration.__dict__:
+        return migration.members_ids
+
+    members_ids = snapshots.get(migration.group_id, migration.pk)
+    # ids of migrations could be reused after cleaning of the table
+    if members_ids is None or len(members_ids) != migration.members_count:
+        members_ids = migration.members_ids
+        snapshots.put(migration.group_id, migration.pk, members_ids)
+    else:
+        migration.members_ids = members_ids
+    return members_ids
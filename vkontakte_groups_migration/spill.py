@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from array import array
+import heapq
+import os
+import tempfile
+
+from django.conf import settings
+
+from .ids import empty, sorted_unique, TYPECODE
+
+SPILL_CHUNK_SIZE = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_SPILL_CHUNK_SIZE', 1000000)
+SPILL_DIR = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_SPILL_DIR', None)
+
+
+def read_chunks(file, size):
+    '''
+    Read file of ids by arrays with `size` ids
+    '''
+    file.seek(0)
+    while True:
+        chunk = empty()
+        try:
+            chunk.fromfile(file, size)
+        except EOFError:
+            # the rest of ids is read anyway
+            pass
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_ids(file, size):
+    for chunk in read_chunks(file, size):
+        for value in chunk:
+            yield value
+
+
+class IdsSpill(object):
+    '''
+    Append-only temporary file with ids, that replaces growing list of ids
+    while fetching members of huge group. Memory usage is bounded by `chunk_size`
+    until the final sorting, the result of sorting is compact array('I')
+    '''
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or SPILL_CHUNK_SIZE
+        self.file = self.make_file()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return read_ids(self.file, self.chunk_size)
+
+    def make_file(self):
+        return tempfile.TemporaryFile(prefix='vkontakte_groups_migration_', dir=SPILL_DIR)
+
+    def extend(self, ids):
+        if not isinstance(ids, array) or ids.typecode != TYPECODE:
+            ids = array(TYPECODE, ids)
+        self.file.seek(0, os.SEEK_END)
+        ids.tofile(self.file)
+        self.count += len(ids)
+
+    def sorted_unique(self):
+        '''
+        External sort: every chunk is sorted and saved to the separate file,
+        after that all sorted chunks are merged with removing of doubles
+        '''
+        runs = []
+        for chunk in read_chunks(self.file, self.chunk_size):
+            run = self.make_file()
+            sorted_unique(chunk).tofile(run)
+            runs.append(run)
+
+        if not runs:
+            return empty()
+        elif len(runs) == 1:
+            result = next(read_chunks(runs[0], self.count))
+        else:
+            result = empty()
+            prev = None
+            buffer_size = max(self.chunk_size / len(runs), 1000)
+            for value in heapq.merge(*[read_ids(sorted_run, buffer_size) for sorted_run in runs]):
+                if value != prev:
+                    result.append(value)
+                    prev = value
+
+        for run in runs:
+            run.close()
+        return result
+
+    def close(self):
+        self.file.close()
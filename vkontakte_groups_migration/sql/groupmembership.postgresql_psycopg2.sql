@@ -13,3 +13,15 @@ WHERE time_left IS NOT NULL;
 CREATE UNIQUE INDEX vkontakte_groups_migration_groupmembersh_time_left_2col_uniq 
 ON vkontakte_groups_migration_groupmembership (group_id, user_id)
 WHERE time_left IS NULL;
+
+CREATE INDEX vkontakte_groups_migration_groupmembership_group_entered
+ON vkontakte_groups_migration_groupmembership (group_id, time_entered);
+
+CREATE INDEX vkontakte_groups_migration_groupmembership_group_left
+ON vkontakte_groups_migration_groupmembership (group_id, time_left);
+
+CREATE INDEX vkontakte_groups_migration_groupmembership_user_group
+ON vkontakte_groups_migration_groupmembership (user_id, group_id);
+
+CREATE INDEX vkontakte_groups_migration_groupmembership_group_period
+ON vkontakte_groups_migration_groupmembership (group_id, (COALESCE(time_left, 'infinity'::timestamptz)), (COALESCE(time_entered, '-infinity'::timestamptz)));
@@ -0,0 +1,2 @@
+CREATE INDEX vkontakte_groups_migration_groupmigration_group_hidden_time
+ON vkontakte_groups_migration_groupmigration (group_id, hidden, time);
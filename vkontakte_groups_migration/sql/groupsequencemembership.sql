@@ -0,0 +1,5 @@
+CREATE INDEX vkontakte_groups_migration_groupsequencemembership_entered
+ON vkontakte_groups_migration_groupsequencemembership (group_id, sequence_entered);
+
+CREATE INDEX vkontakte_groups_migration_groupsequencemembership_left
+ON vkontakte_groups_migration_groupsequencemembership (group_id, sequence_left);
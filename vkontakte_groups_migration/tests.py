@@ -2,18 +2,96 @@
 from django.test import TestCase
 from django.test.testcases import TransactionTestCase
 from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
 from django.db.utils import IntegrityError
-from models import GroupMigration, User, update_group_users
+from models import GroupMigration, GroupSequenceMembership, MembersNotRestored, MigrationTimeline, User, \
+    clear_memberships_constraints, update_group_users
 from vkontakte_users.factories import UserFactory
 from vkontakte_users.tests import user_fetch_mock, USERS_INFO_TIMEOUT_DAYS
 from vkontakte_groups.factories import GroupFactory
 from factories import GroupMigrationFactory, GroupMembershipFactory, GroupMembership
+from bulk import bulk_insert, format_value, IterFile
+from client import HttpClient, parse_members_response
+from fetchers import ConcurrentMembersFetcher, DriftAwareFetcher, ExecuteMembersFetcher, MembersFetcher, RateLimiter
+from scheduler import CrawlScheduler
+from snapshots import SnapshotCache, snapshots
+from spill import IdsSpill
+import partitions
+from tokens import TokenPool
+from vkontakte_api.api import VkontakteError
+import ids
+from array import array
 from datetime import datetime, timedelta
+import logging
 import random
+import re
+import time
+import urlparse
 import mock
 
 GROUP_ID = 30221121
 
+log = logging.getLogger('vkontakte_groups_migration')
+
+
+def members_api_mock(members_ids):
+    '''
+    Returns side effect for mocking of api_call('groups.getMembers', ...)
+    '''
+    def api_call(method, gid, offset=0, count=1000):
+        return {'count': len(members_ids), 'users': members_ids[offset:offset + count]}
+    return api_call
+
+
+def fix_memberships_legacy(self):
+    '''
+    Previous implementation of GroupMigration.fix_memberships with IN lists of members, for benchmarking
+    '''
+    members = tuple(self.next.members_ids)
+    cursor = connection.cursor()
+    cursor.execute('''
+        CREATE TEMP TABLE vkontakte_groups_migration_groupmembership_temp AS
+            SELECT second.group_id, second.user_id, second.time_entered, second.time_left
+            FROM "vkontakte_groups_migration_groupmembership" AS second
+            WHERE (second.time_entered = %(next_time_entered)s
+                AND second.group_id = %(group)s
+                AND second.user_id IN (
+                    SELECT first.user_id FROM "vkontakte_groups_migration_groupmembership" AS first
+                        WHERE (first.group_id = second.group_id
+                            AND first.time_left = %(time_left)s
+                            AND first.user_id IN %(members)s)));
+
+        DELETE FROM "vkontakte_groups_migration_groupmembership" AS second
+            WHERE (second.time_entered = %(next_time_entered)s
+                AND second.group_id = %(group)s
+                AND second.user_id IN (
+                    SELECT first.user_id FROM "vkontakte_groups_migration_groupmembership" AS first
+                        WHERE (first.group_id = second.group_id
+                            AND first.time_left = %(time_left)s
+                            AND first.user_id IN %(members)s)));
+
+        UPDATE "vkontakte_groups_migration_groupmembership" AS first
+            SET time_left = second.time_left
+            FROM "vkontakte_groups_migration_groupmembership_temp" AS second
+            WHERE first.group_id = %(group)s
+              AND first.time_left = %(time_left)s
+              AND first.user_id IN %(members)s
+              AND first.user_id = second.user_id
+              AND second.group_id = first.group_id
+              AND second.time_entered = %(next_time_entered)s;
+
+        DROP TABLE vkontakte_groups_migration_groupmembership_temp;
+        ''', {'group': self.group.pk, 'time_left': self.time, 'members': members, 'next_time_entered': self.next.time})
+
+    GroupMembership.objects.filter(group=self.group, time_left=self.time).exclude(user_id__in=members) \
+        .update(time_left=self.next.time)
+    GroupMembership.objects.filter(group=self.group, time_entered=self.time).exclude(user_id__in=members).delete()
+    GroupMembership.objects.filter(group=self.group, time_entered=self.time).filter(user_id__in=members) \
+        .update(time_entered=self.next.time)
+
+
 class VkontakteGroupsMigrationTest(TestCase):
 
     maxDiff = None
@@ -180,6 +258,363 @@ class VkontakteGroupsMigrationTest(TestCase):
         id90_state1()
         id105_state1()
 
+    def test_ids_field(self):
+
+        migration = GroupMigrationFactory(members_ids=[5, 3, 3, 2 ** 32 - 1, 0])
+        migration = GroupMigration.objects.get(id=migration.id)
+
+        self.assertListEqual(list(migration.members_ids), [0, 3, 5, 2 ** 32 - 1])
+        self.assertListEqual(list(migration.members_entered_ids), [])
+
+        migration.members_ids.extend([1, 2])
+        migration.save()
+        migration = GroupMigration.objects.get(id=migration.id)
+
+        self.assertListEqual(list(migration.members_ids), [0, 1, 2, 3, 5, 2 ** 32 - 1])
+
+    def test_ids_encoding(self):
+
+        members_ids = random.sample(xrange(10 ** 8), 10000) + [0, 127, 128, 2 ** 32 - 1]
+
+        for compression in [None, 'zlib']:
+            data = ids.encode(members_ids, compression)
+            self.assertListEqual(list(ids.decode(data)), sorted(members_ids))
+
+            # pure-python implementation
+            with mock.patch('vkontakte_groups_migration.ids.numpy', None):
+                self.assertEqual(ids.encode(members_ids, compression), data)
+                self.assertListEqual(list(ids.decode(data)), sorted(members_ids))
+
+        for numpy in [ids.numpy, None]:
+            with mock.patch('vkontakte_groups_migration.ids.numpy', numpy):
+                for wrong_ids in [[-1], [2 ** 32], [1, 2, -1]]:
+                    with self.assertRaises(ValueError):
+                        ids.encode(wrong_ids)
+                    with self.assertRaises(ValueError):
+                        ids.sorted_unique(wrong_ids)
+
+        if ids.numpy:
+            for wrong_ids in [[-1], [2 ** 32]]:
+                with self.assertRaises(ValueError):
+                    ids.to_numpy(ids.numpy.array(wrong_ids, dtype=ids.numpy.int64))
+
+    def test_ids_difference(self):
+
+        ids1 = random.sample(xrange(20000), 10000)
+        ids2 = random.sample(xrange(20000), 10000)
+
+        for numpy in [ids.numpy, None]:
+            with mock.patch('vkontakte_groups_migration.ids.numpy', numpy):
+                self.assertListEqual(list(ids.difference(ids1, ids2)), sorted(set(ids1).difference(set(ids2))))
+                self.assertListEqual(list(ids.difference(ids2, ids1)), sorted(set(ids2).difference(set(ids1))))
+                self.assertListEqual(list(ids.difference(ids1, [])), sorted(ids1))
+                self.assertListEqual(list(ids.difference([], ids1)), [])
+
+    def test_ids_checksum(self):
+
+        ids1 = random.sample(xrange(ids.MAX_ID), 10000)
+        ids2 = ids1[:-1] + [ids1[-1] + 1]
+
+        for numpy in [ids.numpy, None]:
+            with mock.patch('vkontakte_groups_migration.ids.numpy', numpy):
+                self.assertEqual(ids.checksum(ids1), sum([(id * 2147483647) % 4294967291 for id in ids1]))
+                self.assertEqual(ids.checksum(ids1), ids.checksum(sorted(ids1)))
+                self.assertNotEqual(ids.checksum(ids1), ids.checksum(ids2))
+                self.assertEqual(ids.checksum([]), 0)
+
+    def test_ids_periods(self):
+
+        snapshots = [random.sample(xrange(1000), random.randint(500, 600)) for i in range(10)]
+        results = []
+        for numpy in [ids.numpy, None]:
+            with mock.patch('vkontakte_groups_migration.ids.numpy', numpy):
+                results += [sorted([(id, entered, left) for user_ids, entered_ids, left in ids.periods(snapshots)
+                                    for id, entered in zip(user_ids, entered_ids)])]
+        self.assertListEqual(results[0], results[1])
+
+        for index, snapshot in enumerate(snapshots):
+            self.assertListEqual(sorted([id for id, entered, left in results[0]
+                                         if entered <= index and (left is None or left > index)]), sorted(snapshot))
+
+        self.assertListEqual(list(ids.periods([])), [])
+
+    def test_check_memberships_count(self):
+
+        group = GroupFactory()
+        for days in range(5, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(range(0, 1500), 1000)).save_final()
+
+        for migration in group.migrations.all():
+            self.assertEqual(GroupMembership.objects.get_checksum(group, migration.time),
+                             (migration.members_count, migration.members_checksum))
+            # only one aggregate query, if checksums are equal
+            with self.assertNumQueries(1):
+                self.assertTrue(migration.check_memberships_count())
+
+        # amount of memberships is the same, but one member is replaced
+        migration = group.migrations.latest('time')
+        group.memberships.filter(user_id=migration.members_ids[0], time_left=None).update(time_left=migration.time)
+        GroupMembership.objects.create(group=group, user_id=2000, time_entered=migration.time)
+        self.assertFalse(migration.check_memberships_count())
+
+        # old migrations without checksum are checked by comparing of ids
+        migration = group.migrations.order_by('time')[0]
+        migration.members_checksum = None
+        self.assertTrue(migration.check_memberships_count())
+
+    def test_ids_spill(self):
+
+        members_ids = [random.randint(0, 10000) for i in range(5000)]
+
+        spill = IdsSpill(chunk_size=700)
+        for offset in range(0, len(members_ids), 1000):
+            spill.extend(members_ids[offset:offset + 1000])
+
+        self.assertEqual(len(spill), len(members_ids))
+        self.assertListEqual(list(spill), members_ids)
+        self.assertListEqual(list(spill.sorted_unique()), sorted(set(members_ids)))
+
+    @mock.patch('vkontakte_groups_migration.signals.update_group_users')
+    def test_update_for_group_streaming(self, update_group_users):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(10000, 12500) + range(0, 2000) + range(11000, 11500)
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=members_api_mock(members_ids)):
+            GroupMigration.objects.update_for_group(group, streaming=True)
+
+        migration = group.migrations.get()
+        self.assertListEqual(list(migration.members_ids), range(0, 2000) + range(10000, 12500))
+        self.assertEqual(migration.members_count, 4500)
+        self.assertEqual(GroupMembership.objects.get_user_ids(group).count(), 4500)
+        self.assertTrue(update_group_users.called)
+
+    @mock.patch('vkontakte_groups_migration.signals.update_group_users')
+    def test_update_for_group_streaming_empty(self, update_group_users):
+
+        self.assertEqual(IdsSpill().sorted_unique(), ids.empty())
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=members_api_mock([])):
+            GroupMigration.objects.update_for_group(group, streaming=True)
+
+        migration = group.migrations.get()
+        self.assertListEqual(list(migration.members_ids), [])
+        self.assertEqual(migration.members_count, 0)
+
+    @mock.patch('vkontakte_groups_migration.models.CHECKPOINT_PAGES', 2)
+    @mock.patch('vkontakte_groups_migration.signals.update_group_users')
+    def test_update_for_group_resuming(self, update_group_users):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(0, 7500)
+        api_call = members_api_mock(members_ids)
+
+        def api_call_crashed(method, gid, offset=0, count=1000):
+            if offset >= 5000:
+                raise Exception('Worker is crashed')
+            return api_call(method, gid, offset=offset, count=count)
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call_crashed):
+            with self.assertRaises(Exception):
+                GroupMigration.objects.update_for_group(group)
+
+        migration = group.migrations.get(time=None)
+        self.assertEqual(migration.offset, 4000)
+        self.assertEqual(migration.checkpoints.count(), 2)
+        self.assertListEqual(list(migration.members_ids), [])
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call) as api_call_mock:
+            GroupMigration.objects.update_for_group(group)
+
+        self.assertListEqual([call[1]['offset'] for call in api_call_mock.call_args_list], [4000, 5000, 6000, 7000, 8000])
+
+        migration = group.migrations.get()
+        self.assertNotEqual(migration.time, None)
+        self.assertEqual(migration.offset, 0)
+        self.assertEqual(migration.checkpoints.count(), 0)
+        self.assertListEqual(list(migration.members_ids), members_ids)
+
+    def test_concurrent_members_fetcher(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(0, 20500)
+        api_call = members_api_mock(members_ids)
+
+        def api_call_slow(method, gid, offset=0, count=1000):
+            time.sleep(random.random() / 100)
+            return api_call(method, gid, offset=offset, count=count)
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call_slow):
+            with mock.patch.object(connections[DEFAULT_DB_ALIAS].__class__, 'close', autospec=True) as close:
+                pages = list(ConcurrentMembersFetcher(group, threads=5, rate=1000).pages())
+
+        # connections are closed once for every thread of the pool, not after every page
+        self.assertLessEqual(close.call_count, 5)
+        self.assertNotIn(id(connections[DEFAULT_DB_ALIAS]), [id(call[0][0]) for call in close.call_args_list])
+
+        self.assertListEqual([offset for offset, ids, count in pages], range(0, 21000, 1000))
+        self.assertListEqual(sum([ids for offset, ids, count in pages], []), members_ids)
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call_slow):
+            with mock.patch('vkontakte_groups_migration.signals.update_group_users'):
+                GroupMigration.objects.update_for_group(group, threads=5)
+
+        self.assertListEqual(list(group.migrations.get().members_ids), members_ids)
+
+    def test_execute_members_fetcher(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(0, 30500)
+        api_call = members_api_mock(members_ids)
+        calls = []
+
+        def api_call_execute(method, code=None, **kwargs):
+            calls.append(method)
+            if method != 'execute':
+                return api_call(method, **kwargs)
+            offsets = map(int, re.findall(r'"offset": (\d+)', code))
+            self.assertLessEqual(len(offsets), 25)
+            # failed call inside execute
+            return [api_call('groups.getMembers', GROUP_ID, offset=offset) if offset != 2000 else False
+                    for offset in offsets]
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call_execute):
+            pages = list(ExecuteMembersFetcher(group, rate=1000).pages())
+
+        self.assertListEqual([offset for offset, ids, count in pages], range(0, 31000, 1000))
+        self.assertListEqual(sum([ids for offset, ids, count in pages], []), members_ids)
+        self.assertListEqual(calls, ['execute', 'groups.getMembers', 'execute'])
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call_execute):
+            with mock.patch('vkontakte_groups_migration.signals.update_group_users'):
+                progress = list(GroupMigration.objects.update_for_group(group, execute=True, as_generator=True))
+
+        self.assertEqual(len(progress), 31)
+        self.assertListEqual(list(group.migrations.get().members_ids), members_ids)
+
+    def test_drift_aware_fetcher(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(10000, 20000)
+        left_ids = range(10100, 10107)
+        stable_ids = sorted(set(members_ids).difference(left_ids))
+
+        def drifting_api_mock():
+            members = list(members_ids)
+            calls = []
+
+            def api_call(method, gid, offset=0, count=1000):
+                calls.append(offset)
+                if len(calls) == 4:
+                    # members left before the boundary, next page is shifted to the left
+                    for id in left_ids:
+                        members.remove(id)
+                elif len(calls) == 7:
+                    # members joined before the boundary, next page is shifted to the right
+                    members[:0] = range(500, 504)
+                return {'count': len(members), 'users': members[offset:offset + count]}
+            return api_call
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=drifting_api_mock()):
+            fetched_ids = sum([page_ids for offset, page_ids, count in MembersFetcher(group, rate=1000).pages()], [])
+        self.assertNotEqual(len(set(stable_ids).difference(fetched_ids)), 0)
+        self.assertNotEqual(len(fetched_ids), len(set(fetched_ids)))
+
+        fetcher = DriftAwareFetcher(MembersFetcher(group, rate=1000))
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=drifting_api_mock()):
+            fetched_ids = sum([page_ids for offset, page_ids, count in fetcher.pages()], [])
+        self.assertEqual(len(set(stable_ids).difference(fetched_ids)), 0)
+        self.assertEqual(len(fetched_ids), len(set(fetched_ids)))
+        self.assertEqual(fetcher.refetches, 1)
+
+    def test_token_pool(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(0, 10500)
+        api_call = members_api_mock(members_ids)
+        calls = []
+
+        def backend(token, method, **kwargs):
+            calls.append(token)
+            if token == 'revoked':
+                raise VkontakteError({'error_code': 5, 'error_msg': '', 'request_params': []})
+            elif token == 'flood' and calls.count(token) == 2:
+                raise VkontakteError({'error_code': 9, 'error_msg': '', 'request_params': []})
+            elif token == 'busy' and calls.count(token) == 1:
+                raise VkontakteError({'error_code': 6, 'error_msg': '', 'request_params': []})
+            return api_call(method, **kwargs)
+
+        pool = TokenPool(source=lambda: ['good', 'revoked', 'flood', 'busy'], backend=backend, rate=1000, backoff=0)
+        pages = list(MembersFetcher(group, pool=pool).pages())
+
+        self.assertListEqual(sum([ids for offset, ids, count in pages], []), members_ids)
+        # revoked and flood tokens are benched after the first error, busy token after backoff is used again
+        self.assertEqual(calls.count('revoked'), 1)
+        self.assertEqual(calls.count('flood'), 2)
+        self.assertGreater(calls.count('busy'), 2)
+        self.assertEqual(len(calls), 12 + 3)
+
+        pool = TokenPool(source=lambda: ['revoked'], backend=backend)
+        with self.assertRaises(VkontakteError):
+            MembersFetcher(group, pool=pool).fetch_page(0)
+
+    def test_http_client(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        members_ids = range(0, 2500)
+        connections = []
+
+        class FakeConnection(object):
+
+            def __init__(self):
+                self.requests = []
+                connections.append(self)
+
+            def request(self, method, url, body, headers):
+                self.requests.append(urlparse.parse_qs(body))
+
+            def getresponse(self):
+                params = self.requests[-1]
+                offset = int(params['offset'][0])
+                users = members_ids[offset:offset + 1000]
+                response = mock.Mock(status=200, getheader=lambda name, default: default)
+                response.read.return_value = '{"response":{"count":%d,"users":[%s]}}' % (
+                    len(members_ids), ','.join(map(str, users)))
+                return response
+
+            def close(self):
+                pass
+
+        client = HttpClient()
+        pool = TokenPool(source=lambda: ['token1', 'token2'], backend=client, rate=1000)
+        with mock.patch.object(HttpClient, 'make_connection', side_effect=FakeConnection):
+            with mock.patch('vkontakte_groups_migration.signals.update_group_users'):
+                GroupMigration.objects.update_for_group(group, fetcher=MembersFetcher(group, pool=pool),
+                                                        streaming=True)
+
+        self.assertListEqual(list(group.migrations.get().members_ids), members_ids)
+        # one keep-alive connection for all requests, tokens are used by turns
+        self.assertEqual(len(connections), 1)
+        self.assertListEqual([params['access_token'][0] for params in connections[0].requests],
+                             ['token1', 'token2', 'token1', 'token2'])
+
+        response = parse_members_response('{"response":{"count":3,"users":[1,20,300]}}')
+        self.assertEqual(response['count'], 3)
+        self.assertEqual(response['users'], array('I', [1, 20, 300]))
+        self.assertEqual(parse_members_response('{"response":{"count":3,"users":[]}}')['users'], array('I'))
+        with self.assertRaises(VkontakteError):
+            parse_members_response('{"error":{"error_code":5,"error_msg":"","request_params":[]}}')
+
+    def test_rate_limiter(self):
+
+        limiter = RateLimiter(20)
+        started = time.time()
+        for i in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - started, 0.19)
+
     def test_comparing_with_statistic(self):
 
         if 'vkontakte_groups_statistic' not in settings.INSTALLED_APPS:
@@ -219,6 +654,261 @@ class VkontakteGroupsMigrationTest(TestCase):
         migration2.compare_entered_left()
         self.assertEqual(migration2.hidden, True)
 
+    def test_migration_timeline(self):
+
+        group = GroupFactory()
+        for days in range(5, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days), members_ids=range(0, 100))
+
+        with self.assertNumQueries(1):
+            migrations = list(MigrationTimeline(group))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(migrations[2].prev, migrations[1])
+            self.assertEqual(migrations[2].next, migrations[3])
+            self.assertEqual(migrations[2].get_prev(1), migrations[0])
+            self.assertEqual(migrations[2].get_next(1), migrations[4])
+            self.assertEqual(migrations[0].prev, None)
+            self.assertEqual(migrations[4].next, None)
+            migrations[2].compare_with_siblings()
+            migrations[2].compare_entered_left()
+
+        # lists of ids are not loaded
+        self.assertTrue(all(['members_ids' not in migration.__dict__ for migration in migrations]))
+
+        # without timeline neighbour is taken by one query
+        migration = group.migrations.order_by('time')[2]
+        with self.assertNumQueries(1):
+            self.assertEqual(migration.prev, migrations[1])
+        with self.assertNumQueries(1):
+            self.assertEqual(migration.get_next(1), migrations[4])
+
+        # hidden migration is removed from the timeline of neighbours
+        migrations[2].hide()
+        self.assertEqual(migrations[3].prev, migrations[1])
+        self.assertEqual(migrations[1].next, migrations[3])
+
+    def test_fix_timeline(self):
+
+        group = GroupFactory()
+        for days in range(16, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(range(0, 1500), 1000)).save_final()
+        migrations = list(group.migrations.order_by('time'))
+
+        # memberships are broken since the 11th migration
+        GroupMembership.objects.filter(group=group, time_entered=migrations[10].time).delete()
+        self.assertFalse(migrations[15].check_memberships_count())
+
+        check_memberships_count = GroupMigration.check_memberships_count
+        save_final = GroupMigration.save_final
+        with mock.patch.object(GroupMigration, 'check_memberships_count', autospec=True,
+                               side_effect=check_memberships_count) as check:
+            with mock.patch.object(GroupMigration, 'save_final', autospec=True, side_effect=save_final) as replay:
+                GroupMembership.objects.fix_timeline(group)
+
+        # the last migration and bisection of 15 previous ones
+        self.assertEqual(check.call_count, 5)
+        # migrations after the consistent one are replayed once
+        self.assertListEqual([call[0][0].pk for call in replay.call_args_list], [m.pk for m in migrations[10:]])
+        for migration in migrations:
+            self.assertTrue(migration.check_memberships_count())
+
+    def test_rebuild_timeline(self):
+
+        group = GroupFactory()
+        for days in range(10, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(range(0, 1500), 1000)).save_final()
+        group.migrations.order_by('time')[4].hide()
+
+        def get_memberships():
+            return list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left'))
+
+        memberships = get_memberships()
+        GroupMembership.objects.filter(group=group, time_entered=group.migrations.visible.order_by('time')[6].time).delete()
+        self.assertNotEqual(get_memberships(), memberships)
+
+        GroupMembership.objects.rebuild_timeline(group)
+        self.assertListEqual(get_memberships(), memberships)
+        for migration in group.migrations.visible:
+            self.assertTrue(migration.check_memberships_count())
+
+    def test_finalize_migrations(self):
+
+        group = GroupFactory()
+        for days in range(10, 7, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(range(0, 1500), 1000)).save_final()
+
+        def get_memberships():
+            return list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left'))
+
+        # backlog of migrations after finalized ones and backlog of the group without migrations
+        for group in [group, GroupFactory()]:
+            migrations = [GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                                members_ids=random.sample(range(0, 1500), 1000)) for days in range(7, 0, -1)]
+            random.shuffle(migrations)
+            GroupMigration.objects.finalize(migrations, batch_size=2)
+
+            migrations = list(group.migrations.order_by('time'))
+            for prev, migration in zip(migrations[:-1], migrations[1:]):
+                self.assertListEqual(list(migration.members_entered_ids), list(ids.difference(migration.members_ids, prev.members_ids)))
+                self.assertListEqual(list(migration.members_left_ids), list(ids.difference(prev.members_ids, migration.members_ids)))
+            for migration in migrations:
+                self.assertTrue(migration.check_memberships_count())
+
+            memberships = get_memberships()
+            GroupMembership.objects.rebuild_timeline(group)
+            self.assertListEqual(get_memberships(), memberships)
+
+        # experimental sequence timeline is not written, if it's not enabled
+        self.assertEqual(GroupSequenceMembership.objects.count(), 0)
+        self.assertEqual(group.migrations.exclude(sequence=None).count(), 0)
+
+        # memberships of the previous migration are broken, so timeline is fixed
+        group.memberships.filter(time_left=None)[0].delete()
+        GroupMigration.objects.finalize([GroupMigrationFactory(group=group, time=datetime.now(),
+                                                               members_ids=random.sample(range(0, 1500), 1000))])
+        for migration in group.migrations.all():
+            self.assertTrue(migration.check_memberships_count())
+
+    def test_finalize_migrations_by_queryset(self):
+
+        group = GroupFactory()
+        GroupMigrationFactory(group=group, time=datetime.now() - timedelta(10),
+                              members_ids=range(0, 10000)).save_final()
+
+        # the migration is compared with the next one, when counters of the next one are updated
+        for days in range(9, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=range(0, 12000) if days > 1 else range(0, 11900))
+        GroupMigration.objects.finalize(group.migrations.filter(members_count=0), batch_size=3)
+
+        migrations = list(group.migrations.order_by('time'))
+        self.assertTrue(migrations[0].hidden)
+        self.assertFalse(any([migration.hidden for migration in migrations[1:]]))
+        for migration in migrations[1:]:
+            self.assertTrue(migration.check_memberships_count())
+
+        memberships = list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left'))
+        GroupMembership.objects.rebuild_timeline(group)
+        self.assertListEqual(list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left')), memberships)
+
+    def test_snapshot_cache(self):
+
+        cache = SnapshotCache(size=4 * 250)
+        cache.put(1, 10, ids.empty())
+        cache.put(2, 20, array('I', range(100)))
+        cache.put(3, 30, array('I', range(100)))
+        self.assertEqual(cache.get(1, 10), ids.empty())
+        self.assertEqual(cache.get(2, 21), None)
+        self.assertEqual(cache.get(3, 30), array('I', range(100)))
+
+        # the least recently used groups are evicted, until new array fits the budget
+        cache.put(4, 40, array('I', range(100)))
+        self.assertListEqual(cache.entries.keys(), [3, 4])
+
+        # the new migration of the group replaces the previous one, too large arrays are not cached
+        cache.put(3, 31, array('I', range(10)))
+        self.assertEqual(cache.get(3, 30), None)
+        self.assertEqual(cache.used, 4 * 110)
+        cache.put(5, 50, array('I', range(300)))
+        self.assertEqual(cache.get(5, 50), None)
+        cache.invalidate(3)
+        self.assertListEqual(cache.entries.keys(), [4])
+
+    def test_cached_members_of_previous_migration(self):
+
+        group = GroupFactory()
+        migration1 = GroupMigrationFactory(group=group, time=datetime.now() - timedelta(2), members_ids=range(0, 100))
+        migration1.save_final()
+        self.assertEqual(snapshots.get(group.pk, migration1.pk), migration1.members_ids)
+
+        # members of the previous migration are not loaded from DB
+        migration2 = GroupMigrationFactory(group=group, time=datetime.now() - timedelta(1), members_ids=range(50, 150))
+        with mock.patch('vkontakte_groups_migration.fields.ids.decode') as decode:
+            migration2.save_final()
+            self.assertFalse(decode.called)
+        self.assertListEqual(list(migration2.members_left_ids), range(0, 50))
+        self.assertEqual(snapshots.get(group.pk, migration2.pk), migration2.members_ids)
+
+        migration2.hide()
+        self.assertEqual(snapshots.get(group.pk, migration2.pk), None)
+
+    def test_keyframes(self):
+
+        group = GroupFactory()
+        members = {}
+        with mock.patch('vkontakte_groups_migration.models.KEYFRAME_INTERVAL', 3):
+            for days in range(8, 0, -1):
+                migration = GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                                  members_ids=random.sample(range(0, 1500), 1000))
+                migration.save_final()
+                members[migration.pk] = list(migration.members_ids)
+
+            def assert_members():
+                snapshots.clear()
+                for migration in list(group.migrations.all()) + list(group.migrations.light):
+                    self.assertListEqual(list(migration.members_ids), members[migration.pk])
+
+            # members are stored only in keyframes
+            migrations = group.migrations.order_by('time')
+            self.assertListEqual([keyframe for keyframe, in migrations.values_list('keyframe')],
+                                 [True, False, False, True, False, False, True, False])
+            self.assertListEqual([value is not None for value, in migrations.values_list('members_ids')],
+                                 [True, False, False, True, False, False, True, False])
+            assert_members()
+
+            # hidden migration becomes keyframe, the next one is restored from the previous visible migration
+            migrations[4].hide()
+            self.assertTrue(migrations[4].keyframe)
+            assert_members()
+            migration = group.migrations.order_by('time')[5]
+            self.assertListEqual(list(migration.members_entered_ids),
+                                 list(ids.difference(members[migration.pk], members[migrations[3].pk])))
+
+            for migration in group.migrations.visible:
+                self.assertTrue(migration.check_memberships_count())
+
+            memberships = list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left'))
+            GroupMembership.objects.rebuild_timeline(group)
+            self.assertListEqual(list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left')),
+                                 memberships)
+
+            # deleting of keyframe by queryset makes the next migration keyframe
+            keyframe = group.migrations.filter(keyframe=True, hidden=False).order_by('-time')[0]
+            group.migrations.filter(pk=keyframe.pk).delete()
+            del members[keyframe.pk]
+            assert_members()
+
+            # all migrations of the group are deleted by queryset without restoring of members
+            group2 = GroupFactory()
+            for days in range(8, 0, -1):
+                GroupMigrationFactory(group=group2, time=datetime.now() - timedelta(days),
+                                      members_ids=random.sample(range(0, 1500), 1000)).save_final()
+            restore = GroupMigration.__dict__['restore_members_ids']
+            with mock.patch.object(GroupMigration, 'restore_members_ids', autospec=True, side_effect=restore) as restoring:
+                group2.migrations.all().delete()
+            self.assertEqual(restoring.call_count, 0)
+            assert_members()
+
+            # members of the next migration are restored once for the gap of deleted migrations
+            gap = list(group.migrations.visible.order_by('time'))[2:4]
+            with mock.patch.object(GroupMigration, 'restore_members_ids', autospec=True, side_effect=restore) as restoring:
+                group.migrations.filter(pk__in=[migration.pk for migration in gap]).delete()
+            self.assertEqual(restoring.call_count, 1)
+            for migration in gap:
+                del members[migration.pk]
+            assert_members()
+
+            # the broken chain isn't restored silently
+            keyframe = group.migrations.filter(keyframe=True, hidden=False).order_by('time')[0]
+            connection.cursor().execute('DELETE FROM %s WHERE id = %%s' % GroupMigration._meta.db_table, [keyframe.pk])
+            snapshots.clear()
+            with self.assertRaises(MembersNotRestored):
+                group.migrations.filter(keyframe=False, hidden=False, time__gt=keyframe.time).order_by('time')[0].members_ids
+
     def test_comparing_with_siblings(self):
 
         migration1 = GroupMigrationFactory(time=datetime.now() - timedelta(2), members_ids=range(0, 100000))
@@ -288,6 +978,165 @@ class VkontakteGroupsMigrationTest(TestCase):
         update_group_users(group)
         self.assertListEqual(list(group.users.order_by('remote_id').values_list('remote_id', flat=True)), range(400, 2000))
 
+    def test_update_users_memberships_fallback(self):
+
+        now = datetime.now()
+
+        def make_timeline(group):
+            for i, members_ids in enumerate([range(0, 800), range(100, 900), range(50, 150) + range(300, 1000)]):
+                migration = GroupMigrationFactory(group=group, time=now - timedelta(10 - i), members_ids=members_ids)
+                migration.save_final()
+            return list(group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left'))
+
+        group1 = GroupFactory()
+        group2 = GroupFactory()
+        memberships = make_timeline(group1)
+        with mock.patch('vkontakte_groups_migration.models.is_postgresql', return_value=False):
+            memberships_fallback = make_timeline(group2)
+
+        self.assertEqual(len(memberships), 800 + 100 + 150)
+        self.assertListEqual(memberships, memberships_fallback)
+        self.assertListEqual(list(GroupMembership.objects.get_user_ids(group1)), range(50, 150) + range(300, 1000))
+
+    def test_bulk_insert(self):
+
+        group1 = GroupFactory()
+        group2 = GroupFactory()
+        time = datetime.now()
+        rows = [(user_id, time if user_id % 2 else None) for user_id in range(0, 2500)]
+
+        bulk_insert(GroupMembership, ['group', 'user_id', 'time_entered'],
+                    ((group1.pk, user_id, time_entered) for user_id, time_entered in rows), chunk_size=1000)
+        with mock.patch('vkontakte_groups_migration.bulk.is_postgresql', return_value=False):
+            bulk_insert(GroupMembership, ['group', 'user_id', 'time_entered'],
+                        ((group2.pk, user_id, time_entered) for user_id, time_entered in rows), chunk_size=1000)
+
+        for group in [group1, group2]:
+            self.assertListEqual(list(group.memberships.order_by('user_id').values_list('user_id', 'time_entered')), rows)
+
+        self.assertEqual(IterFile(['ab', 'cde', '', 'f']).read(4), 'abcd')
+        self.assertEqual(IterFile(['ab', 'cde', '', 'f']).read(), 'abcdef')
+        self.assertEqual(format_value(u'a\tb\\'), 'a\\tb\\\\')
+
+    def test_fix_memberships_benchmark(self):
+
+        now = datetime.now()
+        members_ids = range(0, 30000)
+        migrations_members_ids = [
+            members_ids,
+            random.sample(members_ids, 27500) + range(40000, 42500),
+            members_ids[500:] + range(50000, 50500),
+            members_ids[1000:] + range(50000, 51000),
+        ]
+
+        def hide_migration(group):
+            migrations = []
+            for i, members_ids in enumerate(migrations_members_ids):
+                migration = GroupMigrationFactory(group=group, time=now - timedelta(10 - i), members_ids=members_ids)
+                migration.save_final()
+                migrations.append(migration)
+            started = time.time()
+            migrations[1].hide()
+            seconds = time.time() - started
+            self.assertTrue(migrations[-1].check_memberships_count())
+            memberships = group.memberships.order_by('user_id', 'time_entered').values_list('user_id', 'time_entered', 'time_left')
+            return list(memberships), seconds
+
+        memberships, seconds = hide_migration(GroupFactory())
+        with mock.patch.object(GroupMigration, 'fix_memberships', fix_memberships_legacy):
+            memberships_legacy, seconds_legacy = hide_migration(GroupFactory())
+
+        log.info('Hiding of migration of group with %d members: %.3f seconds, legacy: %.3f seconds' % (
+            len(members_ids), seconds, seconds_legacy))
+        self.assertListEqual(memberships, memberships_legacy)
+
+    def test_memberships_indexes(self):
+
+        # long history of 200 migrations, most of memberships are closed
+        now = datetime.now()
+        times = [now - timedelta(days) for days in range(200, 0, -1)]
+        groups = [GroupFactory() for i in range(20)]
+
+        def rows():
+            # memberships of different groups are interleaved in the table as in real life
+            for user_id in range(0, 10000):
+                for group in groups:
+                    time_entered = times[user_id % 100] if user_id % 10 else None
+                    time_left = times[100 + user_id % 100] if user_id % 4 else None
+                    yield group.pk, user_id, time_entered, time_left
+
+        bulk_insert(GroupMembership, ['group', 'user_id', 'time_entered', 'time_left'], rows())
+        cursor = connection.cursor()
+        cursor.execute('ANALYZE %s' % GroupMembership._meta.db_table)
+
+        def get_plan(qs):
+            sql, params = qs.query.sql_with_params()
+            cursor.execute('EXPLAIN ' + sql, params)
+            return '\n'.join([row[0] for row in cursor.fetchall()])
+
+        group = groups[10]
+        for qs, indexes in [
+            (GroupMembership.objects.get_user_ids(group), ['time_left_2col_uniq', 'active', 'group_left']),
+            (GroupMembership.objects.get_entered_user_ids(group, times[51]), ['group_entered']),
+            (GroupMembership.objects.get_left_user_ids(group, times[150]), ['group_left']),
+            (GroupMembership.objects.get_user_ids(group, times[150]), ['group_period']),
+        ]:
+            plan = get_plan(qs)
+            self.assertNotIn('Seq Scan', plan)
+            self.assertTrue([index for index in indexes if index in plan], plan)
+
+    def test_get_user_ids_at_time(self):
+
+        group = GroupFactory()
+        now = datetime.now()
+        times = [now - timedelta(days) for days in range(10, 0, -1)]
+        for user_id in range(0, 500):
+            time_entered = random.choice([None] + times[:5])
+            time_left = random.choice([None] + [time for time in times if not time_entered or time > time_entered])
+            GroupMembershipFactory(group=group, user_id=user_id, time_entered=time_entered, time_left=time_left)
+
+        for time in [now - timedelta(20)] + times + [now]:
+            user_ids = list(GroupMembership.objects.get_user_ids(group, time))
+            with mock.patch('vkontakte_groups_migration.models.is_postgresql', return_value=False):
+                self.assertListEqual(user_ids, list(GroupMembership.objects.get_user_ids(group, time)))
+
+    def test_repair_memberships(self):
+
+        group = GroupFactory()
+        t = [datetime.now() - timedelta(days) for days in range(10, 0, -1)]
+        # overlapping periods
+        GroupMembershipFactory(group=group, user_id=1, time_entered=t[1], time_left=t[5])
+        GroupMembershipFactory(group=group, user_id=1, time_entered=t[3], time_left=t[7])
+        # closed period inside of active one
+        GroupMembershipFactory(group=group, user_id=2, time_entered=t[2], time_left=None)
+        GroupMembershipFactory(group=group, user_id=2, time_entered=t[4], time_left=t[8])
+        # sequential periods
+        GroupMembershipFactory(group=group, user_id=3, time_entered=t[1], time_left=t[2])
+        GroupMembershipFactory(group=group, user_id=3, time_entered=t[2], time_left=t[3])
+
+        call_command('repair_memberships')
+
+        self.assertEqual(group.memberships.count(), 4)
+        self.assertEqual(group.memberships.filter(user_id=1, time_entered=t[1], time_left=t[7]).count(), 1)
+        self.assertEqual(group.memberships.filter(user_id=2, time_entered=t[2], time_left=None).count(), 1)
+        self.assertEqual(group.memberships.filter(user_id=3).count(), 2)
+
+        # active memberships are unique by index, so they are selected without DISTINCT
+        self.assertTrue(GroupMembership.objects.constraints['active_unique'])
+        self.assertNotIn('DISTINCT', str(GroupMembership.objects.get_user_ids(group).query))
+
+        # constraints are checked again after timeout or migration
+        with mock.patch('vkontakte_groups_migration.models.get_indexes', return_value=[]):
+            self.assertTrue(GroupMembership.objects.constraints['active_unique'])
+            with mock.patch('vkontakte_groups_migration.models.CONSTRAINTS_TIMEOUT', -1):
+                self.assertFalse(GroupMembership.objects.constraints['active_unique'])
+            clear_memberships_constraints()
+        self.assertTrue(GroupMembership.objects.constraints['active_unique'])
+
+        with mock.patch('vkontakte_groups_migration.models.is_postgresql', return_value=False):
+            with self.assertRaisesRegexp(CommandError, 'requires PostgreSQL'):
+                call_command('repair_memberships')
+
     def test_deleting_bad_migration(self):
 
         user_ids = range(1,1000)
@@ -407,6 +1256,103 @@ class VkontakteGroupsMigrationTest(TestCase):
         self.assertItemsEqual(stat5.members_entered_ids, [7])
         self.assertItemsEqual(stat5.members_left_ids, [4])
 
+    @mock.patch('vkontakte_groups_migration.models.SEQUENCE_TIMELINE', True)
+    def test_sequence_timeline(self):
+
+        group = GroupFactory()
+        user_ids = range(1, 300)
+        for days in range(10, 0, -1):
+            GroupMigrationFactory(group=group, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(user_ids, random.randint(200, 220))).save_final()
+
+        def assert_timeline():
+            for migration in group.migrations.visible.order_by('time'):
+                self.assertListEqual(list(GroupSequenceMembership.objects.get_user_ids(migration)), list(migration.members_ids))
+                self.assertListEqual(list(GroupSequenceMembership.objects.get_entered_user_ids(migration)),
+                                     list(migration.members_entered_ids))
+                self.assertListEqual(list(GroupSequenceMembership.objects.get_left_user_ids(migration)),
+                                     list(migration.members_left_ids))
+
+        assert_timeline()
+        self.assertListEqual(list(group.migrations.order_by('time').values_list('sequence', flat=True)), range(1, 11))
+
+        # hiding and deleting of migrations don't change memberships
+        memberships = list(group.sequence_memberships.order_by('id').values_list('user_id', 'sequence_entered', 'sequence_left'))
+        group.migrations.order_by('time')[3].hide()
+        group.migrations.order_by('time')[6].delete()
+        self.assertListEqual(list(group.sequence_memberships.order_by('id').values_list('user_id', 'sequence_entered', 'sequence_left')),
+                             memberships)
+        assert_timeline()
+
+        GroupSequenceMembership.objects.rebuild(group)
+        self.assertListEqual(list(group.migrations.order_by('time').values_list('sequence', flat=True)), range(1, 10))
+        assert_timeline()
+
+    def test_memberships_partitioning(self):
+
+        cursor = connection.cursor()
+        table = GroupMembership._meta.db_table
+        if not partitions.is_supported():
+            return
+
+        group1 = GroupFactory()
+        GroupMigrationFactory(group=group1, time=datetime.now() - timedelta(10), members_ids=range(0, 100)).save_final()
+
+        partitions.partition_table(cursor, table, 'list')
+        self.assertEqual(partitions.get_partitioning(cursor, table), 'list')
+        self.assertEqual(partitions.get_group_partition(cursor, table, group1.pk), '%s_%d' % (table, group1.pk))
+
+        # partition of the new group is created before inserting of memberships
+        group2 = GroupFactory()
+        migrations = []
+        for days in range(9, 4, -1):
+            migrations += [GroupMigrationFactory(group=group1, time=datetime.now() - timedelta(days),
+                                                 members_ids=random.sample(range(0, 150), 100))]
+            migrations[-1].save_final()
+            GroupMigrationFactory(group=group2, time=datetime.now() - timedelta(days),
+                                  members_ids=random.sample(range(0, 150), 100)).save_final()
+        self.assertEqual(partitions.get_group_partition(cursor, table, group2.pk), '%s_%d' % (table, group2.pk))
+        # partitions are known by the process, so they are not read before every writing of memberships
+        with self.assertNumQueries(0):
+            GroupMembership.objects.create_partition(group2)
+        for migration in migrations:
+            self.assertListEqual(list(migration.user_ids), list(migration.members_ids))
+
+        # partition is rebuilt from the rest of memberships
+        time = migrations[1].time
+        memberships = group1.memberships.values_list('id', 'user_id', 'time_entered', 'time_left')
+        expected = [(id, user_id, time_entered, None if time_left and time_left > time else time_left)
+                    for id, user_id, time_entered, time_left in memberships if not time_entered or time_entered <= time]
+        group2_memberships = list(group2.memberships.order_by('id').values_list('id', 'user_id', 'time_entered', 'time_left'))
+
+        GroupMembership.objects.clear_timeline_after(group1, time)
+        self.assertItemsEqual(group1.memberships.values_list('id', 'user_id', 'time_entered', 'time_left'), expected)
+        self.assertListEqual(list(GroupMembership.objects.get_user_ids(group1)), list(migrations[1].members_ids))
+        self.assertListEqual(list(group2.memberships.order_by('id').values_list('id', 'user_id', 'time_entered', 'time_left')),
+                             group2_memberships)
+
+        # partition is truncated
+        GroupMembership.objects.clear_timeline_after_migration(group1, None)
+        self.assertEqual(group1.memberships.count(), 0)
+        self.assertEqual(group2.memberships.count(), len(group2_memberships))
+
+        # partition is truncated and filled from migrations
+        GroupMembership.objects.rebuild_timeline(group1)
+        self.assertTrue(all([migration.check_memberships_count() for migration in group1.migrations.visible]))
+        self.assertEqual(group2.memberships.count(), len(group2_memberships))
+
+        # memberships are moved from the default partition
+        group3 = GroupFactory()
+        GroupMembershipFactory(group=group3, user_id=1)
+        self.assertEqual(partitions.get_group_partition(cursor, table, group3.pk), None)
+        GroupMembership.objects.create_partition(group3)
+        self.assertEqual(partitions.get_group_partition(cursor, table, group3.pk), '%s_%d' % (table, group3.pk))
+        self.assertEqual(group3.memberships.count(), 1)
+
+        partitions.unpartition_table(cursor, table)
+        self.assertEqual(partitions.get_partitioning(cursor, table), None)
+        self.assertEqual(group2.memberships.count(), len(group2_memberships))
+
 class VkontakteGroupsMembershipsTest(TransactionTestCase):
 
     def test_memberships_restrictions1(self):
@@ -436,4 +1382,35 @@ class VkontakteGroupsMembershipsTest(TransactionTestCase):
         kwargs = dict(group=GroupFactory(), user_id=1, time_left=None)
         GroupMembershipFactory(**kwargs)
         with self.assertRaises(IntegrityError):
-            GroupMembershipFactory(**kwargs)
\ No newline at end of file
+            GroupMembershipFactory(**kwargs)
+
+class VkontakteGroupsCrawlTest(TransactionTestCase):
+
+    @mock.patch('vkontakte_groups_migration.signals.update_group_users')
+    def test_crawl_scheduler(self, update_group_users):
+
+        groups_members_ids = {
+            GROUP_ID: range(0, 5500),
+            GROUP_ID + 1: range(100, 2100),
+            GROUP_ID + 2: range(7, 707),
+        }
+        groups = [GroupFactory(remote_id=remote_id) for remote_id in groups_members_ids]
+
+        def api_call(method, gid, offset=0, count=1000):
+            return members_api_mock(groups_members_ids[gid])(method, gid, offset=offset, count=count)
+
+        with mock.patch('vkontakte_groups_migration.fetchers.api_call', side_effect=api_call):
+            scheduler = CrawlScheduler(groups, workers=2, rate=50)
+            progress = list(scheduler.run(as_generator=True))
+
+        for group in groups:
+            self.assertListEqual(list(group.migrations.get().members_ids), groups_members_ids[group.remote_id])
+            self.assertTrue(group in [progress_group for progress_group, offset, count, stats in progress])
+
+        # pages with members and one empty page for every group
+        self.assertEqual(scheduler.stats.pages, 6 + 2 + 1)
+        self.assertEqual(scheduler.stats.requests, 9 + 3)
+        self.assertEqual(len(scheduler.stats.finished), 3)
+        self.assertEqual(len(scheduler.stats.failed), 0)
+        # all groups share one budget of requests
+        self.assertLessEqual(scheduler.stats.requests_per_second, 50)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from django.conf import settings
+from vkontakte import API
+from vkontakte_api.api import VkontakteError
+
+from .client import HTTP_CLIENT, HttpClient
+from .fetchers import RateLimiter, REQUESTS_PER_SECOND
+
+log = logging.getLogger('vkontakte_groups_migration')
+
+TOKEN_POOL = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_TOKEN_POOL', False)
+TOKENS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_TOKENS', None)
+TOKEN_BACKOFF = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_TOKEN_BACKOFF', 1)
+TOKEN_BENCH_SECONDS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_TOKEN_BENCH_SECONDS', 600)
+TOKEN_MAX_ERRORS = getattr(settings, 'VKONTAKTE_GROUPS_MIGRATION_TOKEN_MAX_ERRORS', 3)
+REQUEST_TIMEOUT = getattr(settings, 'VKONTAKTE_API_REQUEST_TIMEOUT', 1)
+
+# user authorization failed, token is expired or revoked
+ERROR_AUTHORIZATION = 5
+# too many requests per second
+ERROR_TOO_MANY_REQUESTS = 6
+# flood control, limit of calls of the method for this token is exhausted
+ERROR_FLOOD_CONTROL = 9
+# internal server error
+ERROR_SERVER = 10
+
+
+def get_tokens():
+    '''
+    Default source of tokens: list from settings or active tokens from DB
+    '''
+    if TOKENS:
+        return list(TOKENS)
+    from oauth_tokens.models import AccessToken
+    return list(AccessToken.objects.filter_active_tokens_of_provider('vkontakte').values_list('access_token', flat=True))
+
+
+def vkontakte_backend(token, method, **kwargs):
+    '''
+    Default backend: request to VK API with the token
+    '''
+    return API(token=token).get(method, timeout=REQUEST_TIMEOUT, **kwargs)
+
+
+def get_token_pool(http_client=None):
+    '''
+    Returns pool of tokens according to settings or None.
+    Keep-alive HTTP client works only as backend of the pool
+    '''
+    http_client = HTTP_CLIENT if http_client is None else http_client
+    if TOKEN_POOL or http_client:
+        return TokenPool(backend=HttpClient() if http_client else None)
+
+
+class Token(object):
+
+    def __init__(self, token, rate):
+        self.token = token
+        self.limiter = RateLimiter(rate)
+        self.errors = 0
+        self.benched_until = 0
+
+    def __repr__(self):
+        return '<Token %s...>' % self.token[:8]
+
+    @property
+    def available(self):
+        return self.benched_until <= time.time()
+
+    def bench(self, seconds):
+        self.benched_until = max(self.benched_until, time.time() + seconds)
+
+
+class TokenPool(object):
+    '''
+    Pool of access tokens, that spreads API calls between tokens by round-robin.
+    Every token has own limiter of requests per second. Token is benched
+    for increasing backoff after errors of limits, for long time after flood control
+    or too many errors in a row, and forever if it's not authorized anymore.
+    Tokens are taken from `source` callable, calls are made by `backend` callable
+    with arguments (token, method, **kwargs)
+    '''
+
+    def __init__(self, source=None, backend=None, rate=None, backoff=None, bench_seconds=None, max_errors=None):
+        self.tokens = [Token(token, rate or REQUESTS_PER_SECOND) for token in (source or get_tokens)()]
+        if not self.tokens:
+            raise ValueError('There is no access tokens for the pool')
+
+        self.backend = backend or vkontakte_backend
+        self.backoff = TOKEN_BACKOFF if backoff is None else backoff
+        self.bench_seconds = TOKEN_BENCH_SECONDS if bench_seconds is None else bench_seconds
+        self.max_errors = max_errors or TOKEN_MAX_ERRORS
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def next_token(self):
+        with self.lock:
+            for i in range(len(self.tokens)):
+                token = self.tokens[self.index]
+                self.index = (self.index + 1) % len(self.tokens)
+                if token.available:
+                    return token
+            token = min(self.tokens, key=lambda token: token.benched_until)
+
+        if token.benched_until == float('inf'):
+            raise VkontakteError({'error_code': ERROR_AUTHORIZATION, 'error_msg': 'All tokens of the pool are not authorized',
+                                  'request_params': []})
+        log.warning('All tokens of the pool are benched, waiting for %s' % token)
+        time.sleep(max(token.benched_until - time.time(), 0))
+        return token
+
+    def handle_error(self, token, e):
+        '''
+        Bench token according to the error, raise error if it's not related to the token
+        '''
+        token.errors += 1
+        if e.code == ERROR_AUTHORIZATION:
+            log.warning('Token %s is not authorized, removed from the pool: %s' % (token, e))
+            token.bench(float('inf'))
+        elif e.code == ERROR_FLOOD_CONTROL or token.errors >= self.max_errors:
+            log.warning('Token %s benched for %s seconds: %s' % (token, self.bench_seconds, e))
+            token.bench(self.bench_seconds)
+            token.errors = 0
+        elif e.code in [ERROR_TOO_MANY_REQUESTS, ERROR_SERVER]:
+            token.bench(self.backoff * 2 ** (token.errors - 1))
+        else:
+            raise e
+
+    def call(self, method, **kwargs):
+        attempts = len(self.tokens) * self.max_errors
+        for attempt in range(attempts):
+            token = self.next_token()
+            token.limiter.wait()
+            try:
+                response = self.backend(token.token, method, **kwargs)
+            except VkontakteError, e:
+                if attempt == attempts - 1:
+                    raise
+                self.handle_error(token, e)
+            else:
+                token.errors = 0
+                return response